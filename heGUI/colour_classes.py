@@ -0,0 +1,272 @@
+"""
+Colour classes of the annotations drawn on the H&E image. Different colours
+can stand for different FOV sizes or sections; every pixel is classified in a
+single pass through a precomputed RGB -> class lookup table, so the cost does
+not grow with the number of classes. The table is split in two levels so the
+part read for most pixels stays in cache. A single RGB range, such as the
+default yellow, is compared directly instead, which is cheaper still.
+
+@Author: Nina Tubau & Kenta Yokote
+"""
+
+import json
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import kernels
+
+# Bits per channel of the first level of the lookup table, per
+# kernels.BACKEND. The compiled lookup reads boundary bins at little extra
+# cost; NumPy gathers them separately, so it uses the flat exact table.
+LUT_BITS = {'numba': 5, 'numpy': 8}
+
+
+class ColourClass:
+
+    def __init__(self, name: str,
+                    rgb_min: Tuple = (0, 0, 0),
+                    rgb_max: Tuple = (255, 255, 255),
+                    hsv_min: Tuple = None,
+                    hsv_max: Tuple = None,
+                    fov_size: int = None
+                    ) -> None:
+        '''
+        A pixel belongs to the class when every channel lies within the
+        inclusive RGB range and, if given, the inclusive HSV range
+        :param name: name of the class
+        :param rgb_min: lower R, G, B bounds in 0-255
+        :param rgb_max: upper R, G, B bounds in 0-255
+        :param hsv_min: lower hue (degrees, 0-360), saturation and value (0-1)
+            bounds. A lower hue above the upper one wraps around red.
+        :param hsv_max: upper hue, saturation and value bounds
+        :param fov_size: FOV size in microns for annotations of this class,
+            None to use the size selected in the GUI
+        '''
+        self.name = name
+        self.rgb_min = tuple(rgb_min)
+        self.rgb_max = tuple(rgb_max)
+        self.hsv_min = None if hsv_min is None else tuple(hsv_min)
+        self.hsv_max = None if hsv_max is None else tuple(hsv_max)
+        self.fov_size = fov_size
+
+    def key(self) -> Tuple:
+        return (self.name, self.rgb_min, self.rgb_max, self.hsv_min, self.hsv_max)
+
+    # Classes loaded again from the same file share their lookup table
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ColourClass) and self.key() == other.key()
+
+    def __hash__(self) -> int:
+        return hash(self.key())
+
+    def matches(self, rgb: np.ndarray, hsv: np.ndarray = None) -> np.ndarray:
+        '''
+        :param rgb: (n, 3) colours in 0-255
+        :param hsv: rgb_to_hsv(rgb), if already computed
+        :return: (n,) bool, whether each colour belongs to the class
+        '''
+        # Channel by channel, reductions over a length-3 axis are slow
+        match = np.ones(rgb.shape[0], bool)
+        for k in range(3):
+            match &= (rgb[:, k] >= self.rgb_min[k]) & (rgb[:, k] <= self.rgb_max[k])
+        if self.hsv_min is not None:
+            if hsv is None:
+                hsv = rgb_to_hsv(rgb)
+            hue_min, hue_max = self.hsv_min[0], self.hsv_max[0]
+            if hue_min <= hue_max:
+                match &= (hsv[:, 0] >= hue_min) & (hsv[:, 0] <= hue_max)
+            else:
+                match &= (hsv[:, 0] >= hue_min) | (hsv[:, 0] <= hue_max)
+            for k in (1, 2):
+                match &= (hsv[:, k] >= self.hsv_min[k]) & (hsv[:, k] <= self.hsv_max[k])
+        return match
+
+
+# The yellow boxes burnt into the H&E: R > 160, G > 100, B < 180
+DEFAULT_COLOUR_CLASSES = (ColourClass('yellow', rgb_min=(161, 101, 0), rgb_max=(255, 255, 179)),)
+
+
+def rgb_to_hsv(rgb: np.ndarray) -> np.ndarray:
+    '''
+    :param rgb: (n, 3) colours in 0-255
+    :return: (n, 3) hue in degrees, saturation and value in 0-1
+    '''
+    rgb = rgb.astype(np.float32) / 255
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    value = np.maximum(np.maximum(r, g), b)
+    delta = value - np.minimum(np.minimum(r, g), b)
+    saturation = np.divide(delta, value, out=np.zeros_like(value), where=value > 0)
+
+    # Hue from whichever channel is the maximum, 0 for greys
+    hue = np.zeros_like(value)
+    safe_delta = np.where(delta > 0, delta, 1)
+    red = (value == r) & (delta > 0)
+    green = (value == g) & ~red & (delta > 0)
+    blue = (delta > 0) & ~red & ~green
+    hue[red] = ((g[red] - b[red]) / safe_delta[red]) % 6
+    hue[green] = (b[green] - r[green]) / safe_delta[green] + 2
+    hue[blue] = (r[blue] - g[blue]) / safe_delta[blue] + 4
+    hue *= 60
+    return np.stack([hue, saturation, value], axis=1)
+
+
+def build_lut(colour_classes=DEFAULT_COLOUR_CLASSES, bits: int = None) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Two level RGB -> class lookup table. The first level has one entry per
+    bin of 2 ** (8 - bits) values per channel. A bin whose colours all belong
+    to the same class holds that label; a bin cut by a class boundary holds
+    256 + i instead, and its colours are looked up exactly in row i of the
+    second level. The classification is therefore exact for any bits, and the
+    boundary bins are the only ones paying for a second lookup.
+    :param colour_classes: sequence of ColourClass, the first matching class wins
+    :param bits: bits per channel of the first level, 5 gives a 32k entry
+        table that stays in cache, 8 a 16M entry table without second level.
+        LUT_BITS of the backend by default.
+    :return: (2 ** (3 * bits),) uint8 first level, uint16 if any bin is cut,
+        and (boundary bins, 2 ** (3 * (8 - bits))) uint8 second level
+    '''
+    assert len(colour_classes) < 256, 'At most 255 colour classes are supported'
+    if bits is None:
+        bits = LUT_BITS[kernels.BACKEND]
+    assert 1 <= bits <= 8, 'Between 1 and 8 bits per channel are supported'
+    return _build_lut(tuple(colour_classes), bits)
+
+
+@lru_cache(maxsize=8)
+def _build_lut(colour_classes, bits):
+    # Every bin as a row of its colours, then split uniform and boundary bins
+    levels, sub = 2 ** bits, 2 ** (8 - bits)
+    exact = _exact_lut(colour_classes).reshape(levels, sub, levels, sub, levels, sub)
+    exact = exact.transpose(0, 2, 4, 1, 3, 5).reshape(levels ** 3, sub ** 3)
+    boundary = (exact != exact[:, :1]).any(axis=1)
+
+    if not boundary.any():
+        return np.ascontiguousarray(exact[:, 0]), exact[:0]
+    bins = exact[:, 0].astype(np.uint16)
+    bins[boundary] = 256 + np.arange(np.count_nonzero(boundary))
+    return bins, np.ascontiguousarray(exact[boundary])
+
+
+def _exact_lut(colour_classes):
+    rgb = np.empty((256 * 256, 3), np.float32)
+    rgb[:, 1:] = np.stack(np.meshgrid(np.arange(256), np.arange(256), indexing='ij'), axis=-1).reshape(-1, 2)
+
+    uses_hsv = any(colour_class.hsv_min is not None for colour_class in colour_classes)
+
+    lut = np.zeros(256 ** 3, np.uint8)
+    # One red value at a time keeps the temporaries small
+    for r in range(256):
+        rgb[:, 0] = r
+        hsv = rgb_to_hsv(rgb) if uses_hsv else None
+        labels = lut[r * 256 ** 2:(r + 1) * 256 ** 2]
+        for i in reversed(range(len(colour_classes))):
+            labels[colour_classes[i].matches(rgb, hsv)] = i + 1
+    return lut
+
+
+def classify(image: np.ndarray, lut: Tuple[np.ndarray, np.ndarray], tile_rows: int = 1024) -> np.ndarray:
+    '''
+    :param image: (rows, cols, >=3) uint8 RGB image
+    :param lut: tables returned by build_lut
+    :param tile_rows: number of rows classified at once, bounds the index temporaries
+    :return: (rows, cols) uint8 class labels, 0 for background
+    '''
+    assert image.dtype == np.uint8, 'Colour classes are defined on uint8 RGB images'
+    bins, boundary = lut
+    bits = int(round(np.log2(bins.shape[0]) / 3))
+    shift = 8 - bits
+    labels = np.empty(image.shape[:2], np.uint8)
+    if kernels.BACKEND == 'numba':
+        return kernels.classify(image, bins, boundary, bits, labels)
+
+    for start in range(0, image.shape[0], tile_rows):
+        block = image[start:start + tile_rows]
+        index = (block[..., 0] >> shift).astype(np.uint32) << (2 * bits)
+        index |= (block[..., 1] >> shift).astype(np.uint32) << bits
+        index |= (block[..., 2] >> shift).astype(np.uint32)
+        tile_labels = np.take(bins, index)
+
+        if len(boundary) > 0:
+            # Pixels in bins cut by a class boundary, looked up exactly
+            cut = tile_labels >= 256
+            colours = block[cut][:, :3].astype(np.uint32) & (2 ** shift - 1)
+            sub_index = (colours[:, 0] << (2 * shift)) | (colours[:, 1] << shift) | colours[:, 2]
+            tile_labels[cut] = boundary[tile_labels[cut] - 256, sub_index]
+        labels[start:start + tile_rows] = tile_labels
+    return labels
+
+
+def classify_colours(image: np.ndarray, colour_classes=DEFAULT_COLOUR_CLASSES, bits: int = None) -> np.ndarray:
+    '''
+    :param image: (rows, cols, >=3) uint8 RGB image
+    :param colour_classes: sequence of ColourClass, the first matching class wins
+    :param bits: bits per channel of the first level of the lookup table, see
+        build_lut. The result does not depend on it, only the speed.
+    :return: (rows, cols) uint8 class labels, 0 for background
+    '''
+    if len(colour_classes) == 1 and colour_classes[0].hsv_min is None:
+        return _classify_rgb_box(image, colour_classes[0])
+    return classify(image, build_lut(colour_classes, bits))
+
+
+def _classify_rgb_box(image, colour_class):
+    # A single RGB range is cheaper to compare directly than to look up,
+    # skipping the bounds every value meets
+    assert image.dtype == np.uint8, 'Colour classes are defined on uint8 RGB images'
+    match = np.ones(image.shape[:2], bool)
+    for k in range(3):
+        if colour_class.rgb_min[k] > 0:
+            match &= image[..., k] >= colour_class.rgb_min[k]
+        if colour_class.rgb_max[k] < 255:
+            match &= image[..., k] <= colour_class.rgb_max[k]
+    return match.view(np.uint8)
+
+
+def load_colour_classes(path: str) -> List[ColourClass]:
+    '''
+    :param path: JSON file with a list of objects holding the ColourClass
+        arguments, e.g. {"name": "yellow", "rgb_min": [161, 101, 0],
+        "rgb_max": [255, 255, 179], "fov_size": 400}
+    :return: list of ColourClass, DEFAULT_COLOUR_CLASSES if path is empty
+    :raises ValueError: if the file is not valid JSON or a class is malformed
+    '''
+    if len(path) == 0:
+        return list(DEFAULT_COLOUR_CLASSES)
+    with open(path) as f:
+        try:
+            definitions: List[Dict] = json.load(f)
+        except ValueError as e:
+            raise ValueError(f'{path} is not a valid JSON file: {e}')
+
+    if not isinstance(definitions, list) or len(definitions) == 0:
+        raise ValueError(f'{path} must hold a non-empty list of colour classes')
+    if len(definitions) > 255:
+        raise ValueError(f'{path}: at most 255 colour classes are supported')
+    return [_parse_colour_class(definition, f'{path}, class {i + 1}') for i, definition in enumerate(definitions)]
+
+
+def _parse_colour_class(definition, where):
+    if not isinstance(definition, dict):
+        raise ValueError(f'{where}: expected an object with the colour class fields')
+    unknown = set(definition) - {'name', 'rgb_min', 'rgb_max', 'hsv_min', 'hsv_max', 'fov_size'}
+    if unknown:
+        raise ValueError(f'{where}: unknown fields {sorted(unknown)}')
+    if not isinstance(definition.get('name'), str):
+        raise ValueError(f'{where}: "name" is required')
+    if ('hsv_min' in definition) != ('hsv_max' in definition):
+        raise ValueError(f'{where}: "hsv_min" and "hsv_max" must be given together')
+
+    for key, upper in (('rgb_min', (255, 255, 255)), ('rgb_max', (255, 255, 255)),
+                       ('hsv_min', (360, 1, 1)), ('hsv_max', (360, 1, 1))):
+        if key in definition:
+            values = definition[key]
+            if not (isinstance(values, list) and len(values) == 3
+                    and all(isinstance(v, (int, float)) and 0 <= v <= u for v, u in zip(values, upper))):
+                raise ValueError(f'{where}: "{key}" must be 3 numbers between 0 and {list(upper)}')
+
+    fov_size = definition.get('fov_size')
+    if fov_size is not None and not (isinstance(fov_size, (int, float)) and fov_size > 0):
+        raise ValueError(f'{where}: "fov_size" must be a positive number of microns')
+    return ColourClass(**definition)
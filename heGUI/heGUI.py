@@ -11,19 +11,37 @@ from tkinter import *
 from tkinter import messagebox
 from tkinter.ttk import *
 
-import he_script
-
 import os
 import json
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import napari
-from skimage import io
 import numpy as np
 
-from skimage import img_as_ubyte
-import napari.layers
 from dotenv import load_dotenv
-from he_script import get_fovs
+from transform import AffineTransform
+from slide import Slide
+
+# napari, scikit-image and mibitracker take seconds to import. They are
+# imported where they are used and preloaded in the background once the
+# window is shown, see preload_modules.
+HEAVY_MODULES = ('he_script', 'skimage.io', 'skimage.measure', 'skimage.transform',
+                 'mibitracker.request_helpers', 'napari', 'napari.qt.threading')
+
+# Stage transform fits with a larger RMS residual are reported to the operator
+STAGE_RMS_WARNING = 20
+# Landmark rows shown for a slide without more landmarks
+MIN_POINT_ROWS = 3
+
+
+def preload_modules():
+    for module in HEAVY_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            print(f'Could not preload {module}: {e}')
+
 
 class heGUI:
 
@@ -121,6 +139,26 @@ class heGUI:
 
         self.row = self.row + 1
 
+        # Colour classes file, optional
+        self.colour_classes_label = Label(window, text = "Select colour classes")
+        self.colour_classes_label.grid(column=col_0, row=self.row)
+
+        self.colour_classes_entryText = StringVar()
+        self.colour_classes_entry = Entry(window, state='disabled', textvariable=self.colour_classes_entryText)
+        self.colour_classes_entry.grid(column=col_1, row=self.row)
+
+        self.colour_classes_button = Button(window, text= "Select", command=lambda : self.select_file(self.colour_classes_entryText, "JSON"))
+        self.colour_classes_button.grid(column=col_2, row=self.row)
+
+        self.row = self.row + 1
+
+        # Sparse layouts (TMAs): only warp the regions around the annotations
+        self.roi_only_var = BooleanVar(value=False)
+        self.roi_only_checkbutton = Checkbutton(window, text="Warp annotated regions only (TMA)", variable=self.roi_only_var)
+        self.roi_only_checkbutton.grid(column=col_1, row=self.row)
+
+        self.row = self.row + 1
+
         # HE Image Entry
         self.output_label = Label(window, text = "Output folder")
         self.output_label.grid(column=col_0, row=self.row)
@@ -194,56 +232,26 @@ class heGUI:
         # self.point_separator = Separator(frame,orient='vertical')
         # self.point_separator.grid(column=1, row=self.row, rowspan=3, sticky='ns')
 
+        self.coordinates_frame = frame
         self.point_separator_2 = Separator(frame,orient='vertical')
         self.point_separator_2.grid(column=4, row=self.row, rowspan=3, sticky='ns')
 
-
-        self.point_one_label = Label(frame, text="Point 1")
-        self.point_one_label.grid(column=0, row=self.row)
-
-        self.point_one_x_entry = Entry(frame, width = 7)
-        self.point_one_x_entry.grid(column=2, row=self.row)
-
-        self.point_one_y_entry = Entry(frame, width = 7)
-        self.point_one_y_entry.grid(column=3, row=self.row)
-
-        self.point_one_x_sed_entry = Entry(frame, width = 7)
-        self.point_one_x_sed_entry.grid(column=5, row=self.row)
-
-        self.point_one_y_sed_entry = Entry(frame, width = 7)
-        self.point_one_y_sed_entry.grid(column=6, row=self.row)
-
-
-        self.row = self.row + 1
-
-        self.point_two_label = Label(frame, text="Point 2")
-        self.point_two_label.grid(column=0, row=self.row)
-        self.point_two_x_entry = Entry(frame, width = 7)
-        self.point_two_x_entry.grid(column=2, row=self.row)
-
-        self.point_two_y_entry = Entry(frame, width = 7)
-        self.point_two_y_entry.grid(column=3, row=self.row)
-
-        self.point_two_x_sed_entry = Entry(frame, width = 7)
-        self.point_two_x_sed_entry.grid(column=5, row=self.row)
-
-        self.point_two_y_sed_entry = Entry(frame, width = 7)
-        self.point_two_y_sed_entry.grid(column=6, row=self.row)
+        # Optical and SED (x, y) entries, one row per landmark
+        self.frame_row = self.row
+        self.optical_point_entries = []
+        self.sed_point_entries = []
+        self.point_labels = []
+        for _ in range(MIN_POINT_ROWS):
+            self.add_point_row()
+        self.row = self.frame_row
+
+        self.add_point_button = Button(window, text="Add point", command = lambda : self.add_point_row())
+        self.add_point_button.grid(column=col_0, columnspan=3, row=self.row)
         self.row = self.row + 1
 
-        self.point_three_label = Label(frame, text="Point 3")
-        self.point_three_label.grid(column=0, row=self.row)
-        self.point_three_x_entry = Entry(frame, width = 7)
-        self.point_three_x_entry.grid(column=2, row=self.row)
-
-        self.point_three_y_entry = Entry(frame, width = 7)
-        self.point_three_y_entry.grid(column=3, row=self.row)
-
-        self.point_three_x_sed_entry = Entry(frame, width = 7)
-        self.point_three_x_sed_entry.grid(column=5, row=self.row)
-
-        self.point_three_y_sed_entry = Entry(frame, width = 7)
-        self.point_three_y_sed_entry.grid(column=6, row=self.row)
+        self.stage_rms_entryText = StringVar(value="Stage fit RMS: -")
+        self.stage_rms_label = Label(window, textvariable=self.stage_rms_entryText)
+        self.stage_rms_label.grid(column=col_0, columnspan=3, row=self.row)
         self.row = self.row + 1
 
         # Separator
@@ -262,6 +270,11 @@ class heGUI:
 
         self.row = self.row + 1
 
+        self.import_annotations_button = Button(window, text = "Import QuPath annotations", width = 30, command=lambda : self.import_annotations())
+        self.import_annotations_button.grid(column=col_0, columnspan=3, row = self.row)
+
+        self.row = self.row + 1
+
         self.fov_button = Button(window, text = "Check number of FOVS", width = 30, command=lambda : self.get_fovs())
         self.fov_button.grid(column=col_0, columnspan=3, row = self.row)
         self.row = self.row + 1
@@ -273,10 +286,37 @@ class heGUI:
         self.generate_json_button.grid(column=col_0, columnspan=3, row = self.row)
         self.row = self.row + 1
 
-        self.optical_placed = False
-        self.he_placed = False
-        self.checked = False
-        self.options = None
+        sep6 = Separator(window,orient=HORIZONTAL).grid(row=self.row, column=col_0,  columnspan=5, sticky='we')
+        self.row = self.row + 1
+
+        # Slide queue, every slide keeps its own inputs and results
+        self.slide_queue_label = Label(window, text="Slide queue")
+        self.slide_queue_label.grid(row = self.row, column=col_0, columnspan=3)
+        self.row = self.row + 1
+
+        self.slide_queue_treeview = Treeview(window, columns=1, height=4, selectmode='browse')
+        self.slide_queue_treeview.grid(column=col_0, columnspan=3, row = self.row)
+        self.slide_queue_treeview.heading('#0', text='Slide')
+        self.slide_queue_treeview.heading('#1', text='Status')
+        self.row = self.row + 1
+
+        self.new_slide_button = Button(window, text="New slide", command = lambda : self.new_slide())
+        self.new_slide_button.grid(column=col_0, row=self.row)
+
+        self.open_slide_button = Button(window, text="Open selected slide", command = lambda : self.open_slide())
+        self.open_slide_button.grid(column=col_1, columnspan=2, row=self.row)
+        self.row = self.row + 1
+
+        # Images are loaded and H&E annotations detected in the background
+        # while the operator works on the current slide
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.slides = []
+        self.slide = None
+        self.window.after(500, self.refresh_queue)
+
+        self.viewer = None
+        self.processing_qt_events = False
+        self.annotation_worker = None
 
     def insert_row(self):
         self.patient_order_treeview.insert("", END, text=self.treeview_row, values= (self.patient_order_entry.get()))
@@ -300,6 +340,15 @@ class heGUI:
             title='Open a file',
             initialdir=os.getcwd())
         entry.set(filename)
+        if filetype == "Image":
+            self.current_slide()
+        elif filetype == "JSON" and len(filename) > 0:
+            from colour_classes import load_colour_classes
+            try:
+                load_colour_classes(filename)
+            except (OSError, ValueError) as e:
+                messagebox.showerror(title="Colour classes", message=e.args)
+                entry.set('')
         return
 
     def select_folder(self, entry: StringVar):
@@ -309,6 +358,134 @@ class heGUI:
         entry.set(foldername)
         return
 
+    def get_form_inputs(self):
+        '''
+        :return: dictionary with the current content of the form
+        '''
+        patient_order = [self.patient_order_treeview.item(child)['values'][0]
+                         for child in self.patient_order_treeview.get_children()]
+        landmarks = [tuple(entry.get() for entry in optical + sed)
+                     for optical, sed in zip(self.optical_point_entries, self.sed_point_entries)]
+        return {
+            'file_naming_convention': self.file_naming_convention_entry.get(),
+            'slide_num': self.slide_num_entry.get(),
+            'mibi_tracker_ID': self.mibi_tracker_ID_entry.get(),
+            'fov': self.fov_combobox.get(),
+            'optical_image': self.optical_image_entry.get(),
+            'he_image': self.he_image_entry.get(),
+            'dat_file': self.dat_file_entry.get(),
+            'colour_classes': self.colour_classes_entry.get(),
+            'roi_only': self.roi_only_var.get(),
+            'output_folder': self.output_entry.get(),
+            'patient_order': patient_order,
+            'landmarks': landmarks,
+        }
+
+    def set_form_inputs(self, inputs, stage_rms=None):
+        '''
+        Fills the form with the inputs of a slide
+        :param inputs: dictionary as returned by get_form_inputs
+        :param stage_rms: RMS of the slide's stage fit, None if not fitted yet
+        '''
+        for entry, key in ((self.file_naming_convention_entry, 'file_naming_convention'),
+                           (self.slide_num_entry, 'slide_num'),
+                           (self.mibi_tracker_ID_entry, 'mibi_tracker_ID')):
+            entry.delete(0, END)
+            entry.insert(0, inputs[key])
+        self.fov_combobox.set(inputs['fov'])
+        self.optical_image_entryText.set(inputs['optical_image'])
+        self.he_image_entryText.set(inputs['he_image'])
+        self.dat_file_entryText.set(inputs['dat_file'])
+        self.colour_classes_entryText.set(inputs['colour_classes'])
+        self.roi_only_var.set(inputs['roi_only'])
+        self.output_entryText.set(inputs['output_folder'])
+
+        for child in self.patient_order_treeview.get_children():
+            self.patient_order_treeview.delete(child)
+        self.treeview_row = 0
+        for name in inputs['patient_order']:
+            self.patient_order_treeview.insert("", END, text=self.treeview_row, values=(name,))
+            self.treeview_row = self.treeview_row + 1
+
+        # As many landmark rows as the slide had
+        n_rows = max(MIN_POINT_ROWS, len(inputs['landmarks']))
+        while len(self.optical_point_entries) < n_rows:
+            self.add_point_row()
+        while len(self.optical_point_entries) > n_rows:
+            self.remove_point_row()
+        for i, (optical, sed) in enumerate(zip(self.optical_point_entries, self.sed_point_entries)):
+            values = inputs['landmarks'][i] if i < len(inputs['landmarks']) else ('',) * 4
+            for entry, value in zip(optical + sed, values):
+                entry.delete(0, END)
+                entry.insert(0, value)
+        self.show_stage_rms(stage_rms)
+
+    def current_slide(self):
+        '''
+        Stores the form into the slide being worked on, creating it if the
+        queue is empty, and starts loading its images
+        :return: Slide
+        '''
+        inputs = self.get_form_inputs()
+        if self.slide is None:
+            self.slide = Slide(inputs)
+            self.slides.append(self.slide)
+        else:
+            self.slide.inputs = inputs
+        self.slide.start_loading(self.executor)
+        self.refresh_queue(reschedule=False)
+        return self.slide
+
+    def leave_slide(self):
+        '''
+        Saves the current slide and, if its landmarks are placed, warps and
+        detects its annotations in the background
+        '''
+        slide = self.current_slide()
+        if slide.optical_placed and slide.he_placed and not slide.checked and slide.target_image is not None:
+            try:
+                slide.start_detection(self.executor, len(slide.inputs['patient_order']))
+            except (OSError, ValueError):
+                # Missing or unmatched landmarks and colour class errors are
+                # reported when the slide's annotations are checked
+                pass
+
+    def new_slide(self):
+        self.leave_slide()
+
+        # Inputs shared by the slides of a run are carried over
+        inputs = self.get_form_inputs()
+        for key in ('slide_num', 'mibi_tracker_ID', 'optical_image', 'he_image'):
+            inputs[key] = ''
+        inputs['patient_order'] = []
+        inputs['landmarks'] = []
+        self.set_form_inputs(inputs)
+
+        self.slide = Slide(self.get_form_inputs())
+        self.slides.append(self.slide)
+        self.refresh_queue(reschedule=False)
+
+    def open_slide(self):
+        selected_items = self.slide_queue_treeview.selection()
+        if len(selected_items) == 0:
+            messagebox.showerror(title="Slide queue", message="No slide selected")
+            return
+        self.leave_slide()
+
+        self.slide = self.slides[int(selected_items[0])]
+        self.set_form_inputs(self.slide.inputs, self.slide.stage_rms)
+        self.refresh_queue(reschedule=False)
+
+    def refresh_queue(self, reschedule=True):
+        for i, slide in enumerate(self.slides):
+            text = ('\u25B6 ' if slide is self.slide else '') + slide.name
+            if self.slide_queue_treeview.exists(str(i)):
+                self.slide_queue_treeview.item(str(i), text=text, values=(slide.status,))
+            else:
+                self.slide_queue_treeview.insert("", END, iid=str(i), text=text, values=(slide.status,))
+        if reschedule:
+            self.window.after(500, self.refresh_queue)
+
     def place_landmarks(self):
         if len(self.optical_image_entry.get())==0:
             messagebox.showerror(title="Transformibi [source]", message="No optical image file selected")
@@ -317,134 +494,303 @@ class heGUI:
             messagebox.showerror(title="Transformibi [target]", message="No H&E image file selected")
             return
 
-        self.source_image = io.imread(self.optical_image_entry.get())
-        self.target_image = io.imread(self.he_image_entry.get())
-        self.target_image = he_script.resize_(self.source_image, self.target_image)
+        slide = self.current_slide()
+        try:
+            slide.wait_loaded(self.executor)
+        except Exception as e:
+            messagebox.showerror(title="Transformibi", message=e.args)
+            return
 
-        self.source_viewer = napari.Viewer(title='Transformibi [source]')
-        self.target_viewer = napari.Viewer(title='Transformibi [target]')
-        self.source_viewer.add_image(self.source_image)
-        self.target_viewer.add_image(self.target_image)
+        # Optical and H&E side by side, each with its own points layer,
+        # restoring the landmarks if the slide was opened before
+        viewer = self.get_viewer(f'Transformibi [source | target] {slide.name}')
+        viewer.add_image(slide.source_image, name='MIBI optical image')
+        slide.source_points = viewer.add_points(None if slide.source_points is None else slide.source_points.data,
+                                                name='Optical landmarks')
+        viewer.add_image(slide.target_image, name='H&E image')
+        slide.target_points = viewer.add_points(None if slide.target_points is None else slide.target_points.data,
+                                                name='H&E landmarks')
+        viewer.grid.stride = 2
+        viewer.grid.enabled = True
         #self.target_viewer.window.add_dock_widget(my_widget, area='right')
         #my_widget()
-        self.target_points = self.target_viewer.add_points()
-        self.source_points = self.source_viewer.add_points()
-        napari.run()
 
 
-        self.optical_placed = True
-        self.he_placed = True
+        slide.optical_placed = True
+        slide.he_placed = True
+        slide.checked = False
 
         return
 
-    def check_annotation(self):
-         ## SECOND STEP: PERFORM ALIGNMENT
-        pts_ref = np.flip(self.target_points.data, axis=1)
-        pts_mov = np.flip(self.source_points.data, axis=1)
-        transformed_target = img_as_ubyte(he_script.align_images(self.target_image, pts_ref, pts_mov))
+    def get_viewer(self, title):
+        '''
+        Returns the napari viewer shared by every step, emptied of the
+        previous step's layers. A new viewer is only opened on first use or
+        after the user closed it.
+        '''
+        import napari
+
+        # Results of a previous step still computing must not land in this one
+        self.annotation_worker = None
+        if self.viewer is None or napari.current_viewer() is not self.viewer:
+            self.viewer = napari.Viewer(title=title)
+            if not self.processing_qt_events:
+                self.processing_qt_events = True
+                self.process_qt_events()
+        else:
+            self.viewer.layers.clear()
+            self.viewer.grid.enabled = False
+            self.viewer.title = title
+            self.viewer.window.show()
+        return self.viewer
+
+    def process_qt_events(self):
+        '''
+        Runs the napari (Qt) event loop from the Tk main loop so both windows
+        stay responsive without blocking in napari.run()
+        '''
+        from qtpy.QtWidgets import QApplication
+
+        app = QApplication.instance()
+        if app is not None:
+            app.processEvents()
+        self.window.after(20, self.process_qt_events)
+
+    def check_landmarks(self, slide, title):
+        '''
+        Shows an error unless the slide's optical and H&E landmarks are placed
+        and match
+        :return: True if the landmarks can be used
+        '''
+        if not (slide.optical_placed and slide.he_placed):
+            messagebox.showerror(title=title, message="Landmarks not placed")
+            return False
+        try:
+            slide.landmarks()
+        except ValueError as e:
+            messagebox.showerror(title=title, message=e.args)
+            return False
+        return True
 
-        i = len(self.patient_order_treeview.get_children())
+    def check_annotation(self):
+        slide = self.current_slide()
+        if not self.check_landmarks(slide, "Check Annotations"):
+            return
+        if self.fit_stage_transform(slide) is None:
+            return
 
+         ## SECOND STEP: PERFORM ALIGNMENT
+        slide.checked = False
 
-        ## THIRD STEP: get coordinates from he annotations
-        contours, binary_rect = he_script.get_annotation_coords(transformed_target)
-        coord = he_script.get_corners(contours, i)
+        from napari.qt.threading import create_worker
 
-        #coord = coord[coord[:, 0].argsort()]
-        pad = lambda x: np.hstack([x, np.ones((x.shape[0], 1))])
-        unpad = lambda x: x[:, :-1]
+        # Tiles are only warped when napari displays them
+        try:
+            transformed_levels, annotation_levels = slide.aligned_levels()
+        except (OSError, ValueError) as e:
+            messagebox.showerror(title="Colour classes", message=e.args)
+            return
 
-        self.A, res, rank, s = he_script.transformation(pad(self.get_optical_coord()), pad(self.get_sed_coord()))
+        i = len(slide.inputs['patient_order'])
 
         ## FOURTH STEP: plot coordinates and adjust if needed
 
-        self.test_viewer = napari.Viewer(title='Test coordinates')
-        self.test_viewer.add_image(transformed_target, name='Transformed H&E')
-        self.test_viewer.add_image(binary_rect, name='Annotations')
-        self.test_viewer.add_image(self.source_image, name='MIBI optical image')
-        self.test_points_min = self.test_viewer.add_points(coord[:, :2])
-        self.test_points_max = self.test_viewer.add_points(coord[:, 2:])
-        napari.run()
-
-        self.checked = True
-
+        self.test_viewer = self.get_viewer(f'Test coordinates {slide.name}')
+        self.test_viewer.add_image(transformed_levels, name='Transformed H&E', multiscale=True)
+        self.test_viewer.add_image(annotation_levels, name='Annotations', multiscale=True)
+        self.test_viewer.add_image(slide.source_image, name='MIBI optical image')
+
+        ## THIRD STEP: get coordinates from he annotations, in the background
+        # (already running if the slide was left with its landmarks placed)
+        detection = slide.start_detection(self.executor, i)
+        worker = create_worker(detection.result)
+        worker.returned.connect(lambda coord, worker=worker: self.show_annotation_corners(coord, worker, slide))
+        worker.errored.connect(lambda e, worker=worker: self.show_detection_error(e, worker))
+        self.annotation_worker = worker
+        worker.start()
+
+    def import_annotations(self):
+        '''
+        Maps the ROIs of a QuPath GeoJSON export straight through the
+        alignment, instead of detecting annotations burnt into the H&E
+        '''
+        slide = self.current_slide()
+        if not self.check_landmarks(slide, "Import annotations"):
+            return
+        if self.fit_stage_transform(slide) is None:
+            return
 
-    def get_optical_coord(self):
-        if (len(self.point_one_x_entry.get())==0 | len(self.point_one_y_entry.get())==0 |
-            len(self.point_two_x_entry.get())==0 | len(self.point_one_y_entry.get())==0 |
-            len(self.point_three_x_entry.get())==0 | len(self.point_one_y_entry.get())==0):
-            messagebox.showerror(title="Optical coordinates", message="One or more of the optical coordinates are not filled")
+        filename = fd.askopenfilename(
+            title='Open a QuPath GeoJSON file',
+            initialdir=os.getcwd(),
+            filetypes=[('GeoJSON', '*.geojson *.json'), ('All files', '*')])
+        if len(filename) == 0:
             return
 
-        return np.array([
-                [int(self.point_one_x_entry.get()), int(self.point_one_y_entry.get())],
-                [int(self.point_two_x_entry.get()), int(self.point_two_y_entry.get())], 
-                [int(self.point_three_x_entry.get()), int(self.point_three_y_entry.get())]])
+        import he_script
+        from qupath import read_geojson_rois
+        from colour_classes import load_colour_classes
 
-    def get_sed_coord(self):
-        if (len(self.point_one_x_sed_entry.get())==0 | len(self.point_one_y_sed_entry.get())==0 |
-            len(self.point_two_x_sed_entry.get())==0 | len(self.point_one_y_sed_entry.get())==0 |
-            len(self.point_three_x_sed_entry.get())==0 | len(self.point_one_y_sed_entry.get())==0):
-            messagebox.showerror(title="Optical coordinates", message="One or more of the optical coordinates are not filled")
+        try:
+            rois = read_geojson_rois(filename)
+            slide.colour_classes = load_colour_classes(slide.inputs['colour_classes'])
+            coord, colour_class = he_script.get_roi_corners(rois, slide.he_to_optical(), slide.colour_classes)
+        except (OSError, ValueError, KeyError, AssertionError) as e:
+            messagebox.showerror(title="Import annotations", message=e.args)
             return
 
-        return np.array([
-                [int(self.point_one_x_sed_entry.get()), int(self.point_one_y_sed_entry.get())],
-                [int(self.point_two_x_sed_entry.get()), int(self.point_two_y_sed_entry.get())], 
-                [int(self.point_three_x_sed_entry.get()), int(self.point_three_y_sed_entry.get())]])
-
+        self.test_viewer = self.get_viewer(f'Imported annotations {slide.name}')
+        self.test_viewer.add_image(slide.source_image, name='MIBI optical image')
+        properties = {'colour_class': colour_class}
+        slide.test_points_min = self.test_viewer.add_points(coord[:, :2], properties=properties)
+        slide.test_points_max = self.test_viewer.add_points(coord[:, 2:], properties=properties)
+        slide.checked = True
 
+    def show_annotation_corners(self, result, worker, slide):
+        if worker is not self.annotation_worker:
+            return
+        coord, colour_class = result
+        #coord = coord[coord[:, 0].argsort()]
+        properties = {'colour_class': colour_class}
+        slide.test_points_min = self.test_viewer.add_points(coord[:, :2], properties=properties)
+        slide.test_points_max = self.test_viewer.add_points(coord[:, 2:], properties=properties)
+        slide.checked = True
 
-    def get_output_file_name(self):
-        output_file = os.path.join(self.output_entry.get(), 
-                    self.file_naming_convention_entry.get() + "_" + f"slide{self.slide_num_entry.get()}" + "_" + self.fov_combobox.get() + ".json"
-        )
-        return output_file
+    def show_detection_error(self, e, worker):
+        if worker is not self.annotation_worker:
+            return
+        messagebox.showerror(title="Check Annotations",
+                             message=f"Annotation detection failed: {e!r}\nClick Check Annotations to retry.")
+
+
+    def add_point_row(self):
+        frame = self.coordinates_frame
+        point_label = Label(frame, text=f"Point {len(self.optical_point_entries) + 1}")
+        point_label.grid(column=0, row=self.frame_row)
+
+        optical_x_entry = Entry(frame, width = 7)
+        optical_x_entry.grid(column=2, row=self.frame_row)
+        optical_y_entry = Entry(frame, width = 7)
+        optical_y_entry.grid(column=3, row=self.frame_row)
+
+        sed_x_entry = Entry(frame, width = 7)
+        sed_x_entry.grid(column=5, row=self.frame_row)
+        sed_y_entry = Entry(frame, width = 7)
+        sed_y_entry.grid(column=6, row=self.frame_row)
+
+        self.point_labels.append(point_label)
+        self.optical_point_entries.append((optical_x_entry, optical_y_entry))
+        self.sed_point_entries.append((sed_x_entry, sed_y_entry))
+        self.point_separator_2.grid(rowspan=len(self.optical_point_entries))
+        self.frame_row = self.frame_row + 1
+
+    def remove_point_row(self):
+        for widget in (self.point_labels.pop(),) + self.optical_point_entries.pop() + self.sed_point_entries.pop():
+            widget.destroy()
+        self.point_separator_2.grid(rowspan=len(self.optical_point_entries))
+        self.frame_row = self.frame_row - 1
+
+    def get_point_coord(self):
+        '''
+        Reads the landmark rows, skipping rows left completely empty
+        :return: (n,2) optical and (n,2) SED coordinates, None if a row is incomplete
+        '''
+        optical_coord = []
+        sed_coord = []
+        for (x_entry, y_entry), (x_sed_entry, y_sed_entry) in zip(self.optical_point_entries, self.sed_point_entries):
+            row = [x_entry.get(), y_entry.get(), x_sed_entry.get(), y_sed_entry.get()]
+            if all(len(value) == 0 for value in row):
+                continue
+            if any(len(value) == 0 for value in row):
+                messagebox.showerror(title="Optical coordinates", message="One or more of the optical or SED coordinates are not filled")
+                return None, None
+            optical_coord.append([float(row[0]), float(row[1])])
+            sed_coord.append([float(row[2]), float(row[3])])
+
+        if len(optical_coord) < 3:
+            messagebox.showerror(title="Optical coordinates", message="At least three optical and SED coordinate pairs are needed")
+            return None, None
+
+        return np.array(optical_coord), np.array(sed_coord)
+
+    def fit_stage_transform(self, slide):
+        '''
+        Fits the optical pixel to stage micron transform of the slide from the
+        landmark rows
+        :return: AffineTransform or None if the coordinates are invalid
+        '''
+        slide.stage_transform = None
+        slide.stage_rms = None
+        optical_coord, sed_coord = self.get_point_coord()
+        if optical_coord is None:
+            self.show_stage_rms(None)
+            return None
+        try:
+            stage_transform = AffineTransform.fit(optical_coord, sed_coord)
+        except AssertionError as e:
+            self.show_stage_rms(None)
+            messagebox.showerror(title="Optical coordinates", message=e.args)
+            return None
+
+        slide.stage_transform = stage_transform
+        slide.stage_rms = stage_transform.rms
+        self.show_stage_rms(slide.stage_rms)
+        if stage_transform.rms > STAGE_RMS_WARNING:
+            residuals = ', '.join(f'{i + 1}: {r:.1f}' for i, r in enumerate(stage_transform.residuals))
+            messagebox.showwarning(title="Optical coordinates",
+                                   message=f"The stage transform fits the points poorly (RMS {stage_transform.rms:.1f} \u03BCm).\n"
+                                           f"Residual per point (\u03BCm): {residuals}")
+        return stage_transform
+
+    def show_stage_rms(self, rms):
+        self.stage_rms_entryText.set("Stage fit RMS: -" if rms is None else f"Stage fit RMS: {rms:.2f} \u03BCm")
 
     def get_fovs(self):
-        pad = lambda x: np.hstack([x, np.ones((x.shape[0], 1))])
-        unpad = lambda x: x[:, :-1]
-        if not self.checked:
+        slide = self.current_slide()
+        inputs = slide.inputs
+        if not slide.checked:
             messagebox.showerror(title="Check FOVs", message="Annotation not checked")
             return
-        if not self.he_placed:
+        if not slide.he_placed:
             messagebox.showerror(title="Check FOVs", message="H&E landmarks not placed")
             return
-        if not self.optical_placed:
+        if not slide.optical_placed:
             messagebox.showerror(title="Check FOVs", message="Optical landmarks not placed")
             return
-        if len(self.output_entry.get()) == 0:
+        if len(inputs['output_folder']) == 0:
             messagebox.showerror(title="Check FOVs", message="No output folder selected")
             return
-        if len(self.file_naming_convention_entry.get()) == 0:
+        if len(inputs['file_naming_convention']) == 0:
             messagebox.showerror(title="Check FOVs", message="No file naming convention provided")
             return
-        if len(self.fov_combobox.get()) == 0:
+        if len(inputs['fov']) == 0:
             messagebox.showerror(title="Check FOVs", message="No FOV selected")
             return
 
+        import he_script
+
         ## Concatenate coordinates and sort again in case it has been adjusted
-        result = np.concatenate((self.test_points_min.data, self.test_points_max.data), axis=1)
-        result = result[result[:, 0].argsort()]
+        result = np.concatenate((slide.test_points_min.data, slide.test_points_max.data), axis=1)
+        order = result[:, 0].argsort()
+        result = result[order]
+        colour_class = slide.test_points_min.properties['colour_class'][order]
 
         ## FITH STEP: Transform coordinates to the stage space
-        transformed_FOV_min = pad(np.flip(result[:,:2], axis=1))@self.A
-        transformed_FOV_max = pad(np.flip(result[:,2:], axis=1))@self.A
+        transformed_FOV_min = slide.stage_transform(np.flip(result[:,:2], axis=1))
+        transformed_FOV_max = slide.stage_transform(np.flip(result[:,2:], axis=1))
 
         ## SEVENTH STEP: SAVE JSON FILE WITH ALL THE FOVS
-        if self.fov_combobox.get() == "400 \u03BCm":
+        if inputs['fov'] == "400 \u03BCm":
             fov_size = 400
         else:
             fov_size = 800
-        i=0
-        patient_order = {}
-        for child in self.patient_order_treeview.get_children():
-            patient_order[i] = self.patient_order_treeview.item(child)['values'][0]
-            i = i + 1
+        # Annotation colours can select their own FOV size
+        fov_size = slide.fov_sizes(colour_class, fov_size)
+        patient_order = dict(enumerate(inputs['patient_order']))
 
-        FOV_grid = np.abs(transformed_FOV_max-transformed_FOV_min)//(fov_size*0.9)
+        FOV_grid = np.abs(transformed_FOV_max-transformed_FOV_min)//(fov_size[:, np.newaxis]*0.9)
 
-        fname_login = self.dat_file_entry.get()
+        fname_login = inputs['dat_file']
         load_dotenv(fname_login)
 
         email = os.getenv('MIBITRACKER_PUBLIC_EMAIL')
@@ -453,7 +799,7 @@ class heGUI:
 
         login_details = {"email": email, "password":password, "BACKEND_URL":BACKEND_URL}
 
-        mibi_tracker_ID = int(self.mibi_tracker_ID_entry.get())
+        mibi_tracker_ID = int(inputs['mibi_tracker_ID'])
 
         try:
             patient_info = he_script.def_slide(mibi_tracker_ID, login_details, patient_order)
@@ -461,25 +807,26 @@ class heGUI:
             messagebox.showerror(title="Check FOVs", message=e.args)
             return
 
-        final_x, final_y, self.options = get_fovs(transformed_FOV_min, patient_info, fov_size, FOV_grid)
+        final_x, final_y, slide.options = he_script.get_fovs(transformed_FOV_min, patient_info, fov_size, FOV_grid)
 
         ## EIGTH STEP: PLOT THE COORDINATES OF ALL FOVS
-        fovs_coord_optical = pad(np.concatenate((np.expand_dims(final_x, axis=1), np.expand_dims(final_y, axis=1)), axis=1))
-        fovs_coord_sed = fovs_coord_optical@np.linalg.inv(self.A)
-        fovs_coord_viewer = napari.Viewer(title='Testing')
-        fovs_coord_viewer.add_image(self.source_image, name='MIBI optical image')
-        fovs_coord_viewer.add_points(np.flip(fovs_coord_sed[:, :2], axis=1))
-        napari.run()
+        fovs_coord_stage = np.column_stack((final_x, final_y))
+        fovs_coord_optical = slide.stage_transform.inverse(fovs_coord_stage)
+        fovs_coord_viewer = self.get_viewer(f'Testing {slide.name}')
+        fovs_coord_viewer.add_image(slide.source_image, name='MIBI optical image')
+        fovs_coord_viewer.add_points(np.flip(fovs_coord_optical, axis=1))
 
         return
 
     def save_json(self):
-        if self.options == None:
+        slide = self.current_slide()
+        if slide.options == None:
             messagebox.showerror(title="Save JSON", message="FOVS not checked")
             return
 
-        with open(self.get_output_file_name(), 'w') as f:
-            json.dump(self.options.get_fov_list_dict(), f, indent=4)
+        with open(slide.get_output_file_name(), 'w') as f:
+            json.dump(slide.options.get_fov_list_dict(), f, indent=4)
+        slide.saved = True
         messagebox.showinfo(title="Save JSON", message="Saved")
         return
 
@@ -489,4 +836,5 @@ class heGUI:
 window = Tk()
 window.winfo_toplevel().title("MIBI Json creator")
 hegui = heGUI(window)
+window.after(0, lambda: threading.Thread(target=preload_modules, daemon=True).start())
 window.mainloop()
@@ -7,17 +7,13 @@ which will be used in the scanning in MIBI.
 """
 
 
-from tifffile import imread
-from skimage import io
 import numpy as np
 
-from skimage.measure import regionprops
-from skimage.measure import label
-from skimage.transform import resize
-
 from typing import Dict
-from mibitracker.request_helpers import MibiRequests
 from FOVlist import Options
+import kernels
+import warp
+from colour_classes import DEFAULT_COLOUR_CLASSES, classify_colours
 
 
 def tile(x_0, y_0, xn, yn, fov_size, overlap_x, overlap_y, slideID, sectionID, map_patient, options):
@@ -62,16 +58,11 @@ def tile(x_0, y_0, xn, yn, fov_size, overlap_x, overlap_y, slideID, sectionID, m
     return x_, y_
 
 
-
-def transformation(x, y):
-    return np.linalg.lstsq(x, y, rcond=None)
-
-
 ##inspired from https://github.com/Jarvis73/Moving-Least-Squares
 
-def mls_affine_deformation(vy, vx, p, q, alpha=1.0, eps=1e-8):
+def mls_affine_field(vy, vx, p, q, alpha=1.0, eps=1e-8, k=None, radius=None):
     """
-    Affine deformation
+    Affine deformation field
     Parameters
     ----------
     vy, vx: ndarray
@@ -84,15 +75,24 @@ def mls_affine_deformation(vy, vx, p, q, alpha=1.0, eps=1e-8):
         parameter used by weights
     eps: float
         epsilon
+    k, radius: int, float
+        if either is given, every pixel only uses its k nearest control
+        points and/or those within radius, see transform.MLSTransform, so the
+        cost no longer grows with the number of control points
 
     Return
     ------
-        A deformed image.
+        float32 array with size [2, grow, gcol], the source (row, col) of
+        every grid pixel. Coordinates falling outside the source are kept.
     """
+    if k is not None or radius is not None:
+        return local_mls_affine_field(vy, vx, p, q, alpha=alpha, eps=eps, k=k, radius=radius)
+    if kernels.BACKEND == 'numba':
+        return kernels.mls_affine_field(vy, vx, p, q, alpha=alpha, eps=eps)
 
     # Change (x, y) to (row, col)
-    q = np.ascontiguousarray(q[:, [1, 0]].astype(np.int16))
-    p = np.ascontiguousarray(p[:, [1, 0]].astype(np.int16))
+    q = np.ascontiguousarray(q[:, [1, 0]], dtype=np.float32)
+    p = np.ascontiguousarray(p[:, [1, 0]], dtype=np.float32)
 
     # Exchange p and q and hence we transform destination pixels to the corresponding source pixels.
     p, q = q, p
@@ -162,47 +162,86 @@ def mls_affine_deformation(vy, vx, p, q, alpha=1.0, eps=1e-8):
         transformers[0][blidx] = vx[blidx] + qstar[0][blidx] - pstar[0][blidx]
         transformers[1][blidx] = vy[blidx] + qstar[1][blidx] - pstar[1][blidx]
 
-    # Removed the points outside the border
-    transformers[transformers < 0] = 0
-    transformers[0][transformers[0] > grow - 1] = 0
-    transformers[1][transformers[1] > gcol - 1] = 0
+    return transformers
+
+
+def local_mls_affine_field(vy, vx, p, q, alpha=1.0, eps=1e-8, k=None, radius=None):
+    """
+    mls_affine_field restricted to nearby control points, found through a
+    k-d tree of the control points. Pixels whose neighbours are too few or
+    too collinear for a local fit blend into the global affine fit.
+    """
+    if kernels.BACKEND == 'numba':
+        return kernels.local_mls_affine_field(vy, vx, p, q, alpha=alpha, eps=eps, k=k, radius=radius)
+
+    from transform import MLSTransform
 
-    return transformers.astype(np.int16)
+    # Destination (x, y) pixels mapped back to the source, hence p and q swapped
+    transform = MLSTransform(q, p, alpha=alpha, eps=eps, k=k, radius=radius)
+    points = np.stack([vy.ravel(), vx.ravel()], axis=1)
+    transformers = transform(points)[:, [1, 0]].T.astype(np.float32)
+    return transformers.reshape((2,) + vx.shape)
 
 
-def get_annotation_coords(target_image):
+def get_annotation_labels(target_image, colour_classes=DEFAULT_COLOUR_CLASSES):
     '''
-    Retrieves the yellow annotation from the target image based on the colour
     :param target_image: H&E image with the annotations
-    :return: contours and binary image
+    :param colour_classes: sequence of colour_classes.ColourClass
+    :return: uint8 image with the class of every pixel, 0 for background and
+        i + 1 for colour_classes[i]
     '''
-    #get yellow annotaitons based on colour
-    new_image = (target_image[..., 0] > 160) * (target_image[..., 1] > 100) * (target_image[..., 2] < 180)
+    return classify_colours(target_image, colour_classes)
+
+
+def get_annotation_coords(target_image, colour_classes=DEFAULT_COLOUR_CLASSES):
+    '''
+    Retrieves the annotations from the target image based on the colour
+    :param target_image: H&E image with the annotations
+    :param colour_classes: sequence of colour_classes.ColourClass, yellow by default
+    :return: contours and class label image
+    '''
+    #get annotaitons based on colour
+    new_image = get_annotation_labels(target_image, colour_classes)
     # skeletonised = skeletonize(new_image > 0)
-    label_im = label(new_image.astype(np.uint8))
-    regions = regionprops(label_im)
+    regions = get_annotation_regions(new_image)
 
 
     # contours = find_contours(new_image)
     return regions, new_image
 
 
-def get_corners(regions, n_annots):
+def get_annotation_regions(label_image):
+    '''
+    :param label_image: binary or class label image of the annotation pixels
+    :return: regionprops of the connected annotations, touching annotations of
+        different classes are separate regions
+    '''
+    from skimage.measure import label, regionprops
+
+    label_im = label(label_image.astype(np.uint8), background=0)
+    return regionprops(label_im)
+
+
+def get_corners(regions, n_annots, label_image=None, classes=None):
     '''
     Get coordinates of the corner right and left of the contours
     :param contours:list of (n,2)-ndarrays
-    :return:array of (n,4) with (n,2) top right and (n,2)left corners for each rectangle
+    :param label_image: class label image the regions were found in, to also
+        return the colour class of each rectangle
+    :param classes: class label of every region, in place of label_image when
+        the regions were found in several crops
+    :return:array of (n,4) with (n,2) top right and (n,2)left corners for each rectangle,
+        and (n,) class labels if label_image or classes is given
     '''
-    regions.sort(key=lambda x: x.area, reverse=True)
+    if classes is None:
+        classes = [1 if label_image is None else label_image[tuple(region.coords[0])] for region in regions]
+    region_classes = sorted(zip(regions, classes), key=lambda x: x[0].area, reverse=True)
 
-    max_diff_pair = (0, 0)
-    for i in range(1, len(regions)):
-        if (abs(regions[i - 1].area - regions[i].area) / regions[i - 1].area) > max_diff_pair[1]:
-            max_diff_pair = (i, (abs(regions[i - 1].area - regions[i].area) / regions[i - 1].area))
-    regions = regions[:max_diff_pair[0]]
+    max_diff_pair = area_gap([region.area for region, _ in region_classes])
+    region_classes = region_classes[:max_diff_pair[0]]
     corners = []
     print(max_diff_pair)
-    for region in regions:
+    for region, colour_class in region_classes:
         #n = n*2
         x_coord_min = region.coords[:,0].min()
         y_coord_min = region.coords[:,1].min()
@@ -212,11 +251,60 @@ def get_corners(regions, n_annots):
 
         #filtering out noise
         # if x_coord_max > 5+x_coord_min and y_coord_max > 5+y_coord_min:
-        corners.append((x_coord_min, y_coord_min, x_coord_max, y_coord_max))
+        corners.append((x_coord_min, y_coord_min, x_coord_max, y_coord_max, colour_class))
 
     corners = sorted(corners, key=lambda element: (element[1], element[0]))
+    corners = np.array(corners, dtype=np.int64).reshape(-1, 5)
 
-    return np.array(corners)
+    if label_image is None and classes is None:
+        return corners[:, :4]
+    return corners[:, :4], corners[:, 4]
+
+
+def area_gap(areas):
+    '''
+    Splits the annotations from the noise by their area
+    :param areas: areas of the regions, in decreasing order
+    :return: (number of regions kept, relative drop in area after the last
+        kept region). The regions before the largest relative drop are kept.
+    '''
+    max_diff_pair = (0, 0)
+    for i in range(1, len(areas)):
+        if (abs(areas[i - 1] - areas[i]) / areas[i - 1]) > max_diff_pair[1]:
+            max_diff_pair = (i, (abs(areas[i - 1] - areas[i]) / areas[i - 1]))
+    return max_diff_pair
+
+
+def get_roi_corners(rois, transform, colour_classes=DEFAULT_COLOUR_CLASSES):
+    '''
+    Maps vector ROIs through a coordinate transform and returns their bounding
+    boxes, without going through the image pixels
+    :param rois: list of ((n,2) vertices in (x, y), classification name), as
+        returned by qupath.read_geojson_rois
+    :param transform: transform.Transform from the ROI coordinates to the
+        output space, e.g. H&E pixels to optical pixels
+    :param colour_classes: sequence of colour_classes.ColourClass whose names
+        are matched against the ROI classifications
+    :return: array of (n,4) with (n,2) top left and (n,2) bottom right corners
+        in (row, col) as get_corners, and (n,) class labels, 0 when the
+        classification matches no class
+    '''
+    assert len(rois) > 0, 'No ROIs to map'
+
+    # All vertices go through the transform in a single call
+    mapped = transform(np.concatenate([vertices for vertices, _ in rois]))
+    mapped = np.split(mapped, np.cumsum([len(vertices) for vertices, _ in rois])[:-1])
+
+    class_labels = {colour_class.name: i + 1 for i, colour_class in enumerate(colour_classes)}
+    corners = []
+    for (_, name), points in zip(rois, mapped):
+        col_min, row_min = points.min(axis=0)
+        col_max, row_max = points.max(axis=0)
+        corners.append((row_min, col_min, row_max, col_max, class_labels.get(name, 0)))
+
+    corners = sorted(corners, key=lambda element: (element[1], element[0]))
+    corners = np.array(corners, dtype=np.float64).reshape(-1, 5)
+    return corners[:, :4], corners[:, 4].astype(np.int64)
 
 
 def resize_(mov, ref):
@@ -224,29 +312,241 @@ def resize_(mov, ref):
     Resizes images
     :param mov: image destination
     :param ref: reference image to be resized
-    :return: ref image matching mov's size
+    :return: ref image matching mov's size, with ref's dtype
     '''
-    return resize(ref, (mov.shape[0], mov.shape[1]))
+    from skimage.transform import resize
+
+    resized = resize(ref, (mov.shape[0], mov.shape[1]), preserve_range=True)
+    if np.issubdtype(ref.dtype, np.integer):
+        resized = np.rint(resized)
+    return resized.astype(ref.dtype, copy=False)
 
-def align_images(target_image, pts_ref, pts_mov):
+def align_images(target_image, pts_ref, pts_mov, order=1, fill_value=0, tile_rows=512, out=None, k=None, radius=None):
     '''
     :param target_image: HE image
     :param pts_ref: reference points on the HE image
     :param pts_mov: moving points
-    :return: align HE image to the MIBI image
+    :param order: 0 for nearest neighbour, 1 for bilinear sampling
+    :param fill_value: value of the pixels mapped from outside the HE image
+    :param tile_rows: number of output rows warped at once, bounds the size
+        of the deformation field held in memory
+    :param out: optional array to write the aligned image into
+    :param k: use only the k nearest landmarks of every pixel
+    :param radius: use only the landmarks within radius pixels
+    :return: align HE image to the MIBI image, with target_image's dtype
     '''
-    height, width, _ = target_image.shape
-    gridX = np.arange(width, dtype=np.int16)
-    gridY = np.arange(height, dtype=np.int16)
+    height, width = target_image.shape[:2]
+    if out is None:
+        out = np.empty_like(target_image)
 
-    vy, vx = np.meshgrid(gridX, gridY)
-    affine = mls_affine_deformation(vy, vx, pts_ref, pts_mov, alpha=1)
-    transformed_target = np.ones_like(target_image)
-    transformed_target[vx, vy] = target_image[tuple(affine)]
+    gridX = np.arange(width, dtype=np.int32)
+    for start in range(0, height, tile_rows):
+        gridY = np.arange(start, min(start + tile_rows, height), dtype=np.int32)
+        vy, vx = np.meshgrid(gridX, gridY)
+        field = mls_affine_field(vy, vx, pts_ref, pts_mov, alpha=1, k=k, radius=radius)
+        warp.remap(target_image, field, order=order, fill_value=fill_value, out=out[gridY[0]:gridY[-1] + 1])
 
-    return transformed_target
+    return out
 
 
+def lazy_align_images(target_image, pts_ref, pts_mov, order=1, fill_value=0, tile_size=512, cache_size=64,
+                      k=None, radius=None):
+    '''
+    Same alignment as align_images, but nothing is warped until a tile is read
+    :param target_image: HE image
+    :param pts_ref: reference points on the HE image
+    :param pts_mov: moving points
+    :return: list of warp.LazyTiledImage, the aligned HE image at full
+        resolution followed by successively halved levels
+    '''
+    field_fn = lambda vy, vx: mls_affine_field(vy, vx, pts_ref, pts_mov, alpha=1, k=k, radius=radius)
+    return warp.lazy_warp(target_image, field_fn, order=order, fill_value=fill_value,
+                          tile_size=tile_size, cache_size=cache_size)
+
+
+def lazy_annotation_labels(aligned_levels, colour_classes=DEFAULT_COLOUR_CLASSES):
+    '''
+    :param aligned_levels: output of lazy_align_images
+    :param colour_classes: sequence of colour_classes.ColourClass
+    :return: list of warp.LazyTiledImage with the class label image of every
+        level
+    '''
+    return warp.lazy_map(aligned_levels, lambda tile: classify_colours(tile, colour_classes), np.uint8,
+                         channel_axis=False)
+
+
+def annotation_thumbnail(target_image, colour_classes=DEFAULT_COLOUR_CLASSES, step=8, band_rows=4096):
+    '''
+    :param target_image: H&E image with the annotations, before alignment
+    :param colour_classes: sequence of colour_classes.ColourClass
+    :param step: downsampling factor of the thumbnail
+    :param band_rows: number of rows classified at once
+    :return: int thumbnail, the number of pixels of each step x step block
+        that belong to a colour class. Unlike plain subsampling, annotation
+        lines thinner than step are kept.
+    '''
+    height, width = target_image.shape[:2]
+    cols = -(-width // step)
+    thumbnail = np.zeros((-(-height // step), cols), np.int32)
+
+    band_rows = max(band_rows // step, 1) * step
+    for start in range(0, height, band_rows):
+        band = classify_colours(target_image[start:start + band_rows], colour_classes) > 0
+        rows = -(-band.shape[0] // step)
+        padded = np.zeros((rows * step, cols * step), bool)
+        padded[:band.shape[0], :width] = band
+        thumbnail[start // step:start // step + rows] = padded.reshape(rows, step, cols, step).sum(axis=(1, 3))
+    return thumbnail
+
+
+def find_annotation_candidates(target_image, colour_classes=DEFAULT_COLOUR_CLASSES, step=8, min_area=1):
+    '''
+    Finds the regions that may hold annotations on a thumbnail of the H&E
+    :param target_image: H&E image with the annotations, before alignment
+    :param colour_classes: sequence of colour_classes.ColourClass
+    :param step: downsampling factor of the thumbnail
+    :param min_area: smallest candidate kept, in thumbnail pixels. Specks are
+        kept by default, get_corners relies on them to tell annotations from
+        noise.
+    :return: (n,4) int boxes (row min, col min, row max, col max) in
+        target_image pixels, max exclusive, and (n,) number of annotation
+        pixels in each
+    '''
+    thumbnail = annotation_thumbnail(target_image, colour_classes, step)
+    regions = [region for region in get_annotation_regions(thumbnail > 0) if region.area >= min_area]
+    boxes = np.array([region.bbox for region in regions], dtype=np.int64).reshape(-1, 4) * step
+    boxes[:, 2] = np.minimum(boxes[:, 2], target_image.shape[0])
+    boxes[:, 3] = np.minimum(boxes[:, 3], target_image.shape[1])
+    areas = np.array([thumbnail[region.coords[:, 0], region.coords[:, 1]].sum() for region in regions], dtype=np.int64)
+    return boxes, areas
+
+
+def aligned_boxes(boxes, pts_ref, pts_mov, shape, padding=64, k=None, samples=8):
+    '''
+    Maps boxes of the H&E image into the aligned image
+    :param boxes: (n,4) boxes (row min, col min, row max, col max), max exclusive
+    :param pts_ref: reference points on the HE image
+    :param pts_mov: moving points
+    :param shape: shape of the aligned image
+    :param padding: margin in pixels added around each mapped box, absorbs
+        the approximate inverse of the MLS mapping
+    :param k: use only the k nearest landmarks, as in align_images
+    :param samples: points sampled along each side of a box, the mapping bends
+        straight sides
+    :return: (m,4) padded boxes clipped to shape, overlapping boxes merged
+    '''
+    from transform import MLSTransform
+
+    if len(boxes) == 0:
+        return boxes
+    t = np.linspace(0, 1, samples)
+    outline = []
+    for r0, c0, r1, c1 in boxes:
+        rows = np.concatenate([np.full(samples, r0), np.full(samples, r1), r0 + t * (r1 - r0), r0 + t * (r1 - r0)])
+        cols = np.concatenate([c0 + t * (c1 - c0), c0 + t * (c1 - c0), np.full(samples, c0), np.full(samples, c1)])
+        outline.append(np.stack([cols, rows], axis=1))
+
+    # H&E (x, y) to aligned (x, y), all outlines in a single call
+    mapped = MLSTransform(pts_ref, pts_mov, k=k)(np.concatenate(outline)).reshape(len(boxes), -1, 2)
+    mapped_boxes = np.stack([mapped[..., 1].min(axis=1) - padding, mapped[..., 0].min(axis=1) - padding,
+                             mapped[..., 1].max(axis=1) + padding, mapped[..., 0].max(axis=1) + padding], axis=1)
+    mapped_boxes = np.floor(mapped_boxes).astype(np.int64)
+    mapped_boxes[:, :2] = np.maximum(mapped_boxes[:, :2], 0)
+    mapped_boxes[:, 2] = np.minimum(mapped_boxes[:, 2], shape[0])
+    mapped_boxes[:, 3] = np.minimum(mapped_boxes[:, 3], shape[1])
+    mapped_boxes = mapped_boxes[(mapped_boxes[:, 2] > mapped_boxes[:, 0]) & (mapped_boxes[:, 3] > mapped_boxes[:, 1])]
+    return merge_boxes(mapped_boxes)
+
+
+def merge_boxes(boxes):
+    '''
+    :param boxes: (n,4) boxes (row min, col min, row max, col max), max exclusive
+    :return: (m,4) boxes, each the union of a group of overlapping boxes, so
+        no annotation is split between two crops
+    '''
+    boxes = [list(box) for box in boxes]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(len(boxes) - 1, i, -1):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    merged = True
+    return np.array(boxes, dtype=np.int64).reshape(-1, 4)
+
+
+def get_roi_annotation_corners(target_image, pts_ref, pts_mov, n_annots, colour_classes=DEFAULT_COLOUR_CLASSES,
+                               step=8, padding=64, k=None, order=1, fill_value=0, max_workers=None, speck_area=64):
+    '''
+    Same annotation corners as aligning the whole H&E and running
+    get_annotation_coords and get_corners on it, but only the padded regions
+    around annotation candidates are warped, so the work follows the
+    annotated area rather than the slide area
+    :param target_image: HE image
+    :param pts_ref: reference points on the HE image
+    :param pts_mov: moving points
+    :param n_annots: number of patients on the slide
+    :param colour_classes: sequence of colour_classes.ColourClass
+    :param step: downsampling factor of the thumbnail the candidates are found on
+    :param padding: margin in pixels warped around each candidate
+    :param k: use only the k nearest landmarks, as in align_images
+    :param max_workers: number of crops processed in parallel
+    :param speck_area: candidates with fewer annotation pixels are not warped.
+        get_corners only needs their area to tell the annotations from the
+        noise, it is estimated from the area scale of the affine fit of the
+        landmarks. Specks that would be kept as annotations are warped anyway.
+    :return: (n,4) corners and (n,) class labels, as get_corners
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    from types import SimpleNamespace
+    from transform import MLSTransform
+
+    candidates, areas = find_annotation_candidates(target_image, colour_classes, step)
+    mapping = MLSTransform(pts_ref, pts_mov, k=k)
+    aligned_areas = areas * abs(np.linalg.det(mapping.affine.linear))
+    # Aligned (row, col) of the candidate centres, to skip the specks a crop already holds
+    centres = mapping(np.stack([candidates[:, 1] + candidates[:, 3], candidates[:, 0] + candidates[:, 2]],
+                               axis=1) / 2)[:, ::-1]
+
+    def detect(roi):
+        r0, c0, r1, c1 = roi
+        vy, vx = np.meshgrid(np.arange(c0, c1, dtype=np.int32), np.arange(r0, r1, dtype=np.int32))
+        field = mls_affine_field(vy, vx, pts_ref, pts_mov, alpha=1, k=k)
+        crop = warp.remap(target_image, field, order=order, fill_value=fill_value)
+        regions, labels = get_annotation_coords(crop, colour_classes)
+        classes = [labels[tuple(region.coords[0])] for region in regions]
+        # get_corners only needs the area and the coordinates in the full image
+        regions = [SimpleNamespace(area=region.area, coords=region.coords + (r0, c0)) for region in regions]
+        return regions, classes
+
+    warped = areas >= speck_area
+    # NumPy and the labelling release the GIL, and the Numba kernels run on a
+    # thread-safe layer (see kernels), so the crops are processed in parallel
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            rois = aligned_boxes(candidates[warped], pts_ref, pts_mov, target_image.shape, padding=padding, k=k)
+            results = list(executor.map(detect, rois))
+            regions = [region for crop_regions, _ in results for region in crop_regions]
+            classes = [colour_class for _, crop_classes in results for colour_class in crop_classes]
+
+            specks = ~warped
+            for r0, c0, r1, c1 in rois:
+                specks &= ~((centres[:, 0] >= r0) & (centres[:, 0] < r1) & (centres[:, 1] >= c0) & (centres[:, 1] < c1))
+            sorted_areas = sorted([region.area for region in regions] + list(aligned_areas[specks]), reverse=True)
+            n_kept = area_gap(sorted_areas)[0]
+            kept = specks & (aligned_areas >= (sorted_areas[n_kept - 1] if n_kept else np.inf))
+            if not kept.any():
+                break
+            warped |= kept
+
+    # Never kept, so their coordinates are not needed
+    regions += [SimpleNamespace(area=area, coords=None) for area in aligned_areas[specks]]
+    classes += [0] * int(specks.sum())
+    return get_corners(regions, n_annots, classes=classes)
+
 def def_slide(mibi_tracker_ID: int, login_details: Dict, patient_order: Dict) -> Dict:
     '''
     :param mibi_tracker_ID: ID displayed in the first column in MIBI tracker
@@ -254,6 +554,8 @@ def def_slide(mibi_tracker_ID: int, login_details: Dict, patient_order: Dict) ->
     :param patient_order: Ordering of the annotations in the slide
     :return patient_info:
     '''
+    from mibitracker.request_helpers import MibiRequests
+
     email = login_details["email"]
     password = login_details["password"]
     BACKEND_URL = login_details["BACKEND_URL"]
@@ -288,7 +590,7 @@ def get_fovs(transformed_FOV_min, patient_info, fov_size, FOV_grid):
     '''
     :param transformed_FOV_min:
     :param patient_info:
-    :param fov_size:
+    :param fov_size: FOV size in microns, or one size per region
     :param FOV_grid:
     :return:
     '''
@@ -296,9 +598,12 @@ def get_fovs(transformed_FOV_min, patient_info, fov_size, FOV_grid):
     final_y = np.empty(1)
     assert transformed_FOV_min.shape[0] == len(patient_info['sectionMap']), 'There are more regions selected than patient, review your selections'
 
+    fov_sizes = np.broadcast_to(fov_size, (transformed_FOV_min.shape[0],))
+
     options = Options()
     for i in range(len(patient_info['sectionMap'])):
 
+        fov_size = int(fov_sizes[i])
         x_0 = transformed_FOV_min[i, 0] + fov_size/2
         y_0 = transformed_FOV_min[i, 1] - fov_size/2
         xn = FOV_grid[i, 0]
@@ -0,0 +1,375 @@
+"""
+Compiled per-pixel kernels for the moving least squares field and the remap
+used by align_images, and for the colour class lookup.
+
+Numba is optional: when it is installed the kernels below are JIT compiled and
+parallelised over image rows, streaming through the control points for every
+pixel so no [ctrls, ..., grow, gcol] temporaries are allocated. The backend is
+chosen once at import time; he_script falls back to its NumPy implementation
+when BACKEND is 'numpy', and so do warp.remap and colour_classes.classify.
+
+The kernels are called from several threads at once (napari tile requests,
+background detection, ROI crops), which Numba's default workqueue layer
+aborts on. Numba is therefore only used with a thread-safe layer, OpenMP or
+TBB, and left aside when neither can be loaded.
+
+@Author: Nina Tubau & Kenta Yokote
+"""
+
+import numpy as np
+
+try:
+    from numba import config, njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+def _load_threadsafe_layer() -> bool:
+    '''
+    :return: whether Numba could start a thread-safe threading layer
+    '''
+    # OpenMP first, TBB hangs the interpreter at exit after parallel kernels
+    # ran from worker threads
+    config.THREADING_LAYER = 'threadsafe'
+    config.THREADING_LAYER_PRIORITY = ['omp', 'tbb', 'workqueue']
+    try:
+        from numba.np.ufunc.parallel import _launch_threads
+        _launch_threads()
+    except (ImportError, ValueError):
+        return False
+    return True
+
+
+BACKEND = 'numba' if HAS_NUMBA and _load_threadsafe_layer() else 'numpy'
+
+
+if HAS_NUMBA:
+
+    @njit(parallel=True, cache=True)
+    def _mls_affine_field(vy, vx, p, q, alpha, eps, transformers):
+        grow, gcol = vx.shape
+        ctrls = p.shape[0]
+        for r in prange(grow):
+            w = np.empty(ctrls, np.float32)
+            for c in range(gcol):
+                v0 = np.float32(vx[r, c])
+                v1 = np.float32(vy[r, c])
+
+                # Weights and weighted centroids
+                w_sum = np.float32(0)
+                for i in range(ctrls):
+                    d0 = p[i, 0] - v0
+                    d1 = p[i, 1] - v1
+                    w[i] = np.float32(1.0 / (d0 * d0 + d1 * d1 + eps) ** alpha)
+                    w_sum += w[i]
+                pstar0 = np.float32(0)
+                pstar1 = np.float32(0)
+                qstar0 = np.float32(0)
+                qstar1 = np.float32(0)
+                for i in range(ctrls):
+                    w[i] /= w_sum
+                    pstar0 += w[i] * p[i, 0]
+                    pstar1 += w[i] * p[i, 1]
+                    qstar0 += w[i] * q[i, 0]
+                    qstar1 += w[i] * q[i, 1]
+
+                # pTwp and its inverse
+                a = np.float32(0)
+                b = np.float32(0)
+                d = np.float32(0)
+                for i in range(ctrls):
+                    phat0 = p[i, 0] - pstar0
+                    phat1 = p[i, 1] - pstar1
+                    a += w[i] * phat0 * phat0
+                    b += w[i] * phat0 * phat1
+                    d += w[i] * phat1 * phat1
+                det = a * d - b * b
+
+                if det < 1e-8:
+                    # Singular pTwp, only translate by the centroids
+                    t0 = v0 + qstar0 - pstar0
+                    t1 = v1 + qstar1 - pstar1
+                else:
+                    m0 = v0 - pstar0
+                    m1 = v1 - pstar1
+                    l0 = (m0 * d - m1 * b) / det
+                    l1 = (m1 * a - m0 * b) / det
+                    t0 = qstar0
+                    t1 = qstar1
+                    for i in range(ctrls):
+                        A = (l0 * (p[i, 0] - pstar0) + l1 * (p[i, 1] - pstar1)) * w[i]
+                        t0 += A * (q[i, 0] - qstar0)
+                        t1 += A * (q[i, 1] - qstar1)
+
+                transformers[0, r, c] = t0
+                transformers[1, r, c] = t1
+
+    @njit(parallel=True, cache=True)
+    def _local_mls_affine_field(vy, vx, p, q, alpha, eps, n_keep, kth, radius, block, offsets, candidates,
+                                linear, offset, spread_min, spread_full, transformers):
+        grow, gcol = vx.shape
+        block_cols = (gcol + block - 1) // block
+        radius2 = radius * radius
+        for bi in prange((grow + block - 1) // block):
+            sel_d2 = np.empty(n_keep, np.float64)
+            sel_i = np.empty(n_keep, np.int64)
+            w = np.empty(n_keep, np.float64)
+            taper = np.empty(n_keep, np.float64)
+            for bj in range(block_cols):
+                b = bi * block_cols + bj
+                for r in range(bi * block, min((bi + 1) * block, grow)):
+                    for c in range(bj * block, min((bj + 1) * block, gcol)):
+                        v0 = np.float64(vx[r, c])
+                        v1 = np.float64(vy[r, c])
+
+                        # Nearest candidates of the block, sorted by distance
+                        cnt = 0
+                        for j in range(offsets[b], offsets[b + 1]):
+                            i = candidates[j]
+                            d0 = p[i, 0] - v0
+                            d1 = p[i, 1] - v1
+                            d2 = d0 * d0 + d1 * d1
+                            if d2 > radius2:
+                                continue
+                            if cnt < n_keep:
+                                pos = cnt
+                                cnt += 1
+                            elif d2 < sel_d2[cnt - 1]:
+                                pos = cnt - 1
+                            else:
+                                continue
+                            while pos > 0 and sel_d2[pos - 1] > d2:
+                                sel_d2[pos] = sel_d2[pos - 1]
+                                sel_i[pos] = sel_i[pos - 1]
+                                pos -= 1
+                            sel_d2[pos] = d2
+                            sel_i[pos] = i
+
+                        # The (k+1)th neighbour only sets where the weights reach zero
+                        support = radius
+                        m = cnt
+                        if kth:
+                            m = min(cnt, n_keep - 1)
+                            if cnt == n_keep:
+                                support = min(np.sqrt(sel_d2[n_keep - 1]), radius)
+
+                        w_sum = 0.0
+                        t_sum = 0.0
+                        for t in range(m):
+                            rr = np.sqrt(sel_d2[t]) / support if np.isfinite(support) else 0.0
+                            tt = max(1.0 - rr, 0.0)
+                            taper[t] = tt ** 4 * (4 * rr + 1)
+                            w[t] = taper[t] / (sel_d2[t] + eps) ** alpha
+                            w_sum += w[t]
+                            t_sum += taper[t]
+
+                        # Spread of the tapered neighbours, as transform.local_blend
+                        blend = 0.0
+                        if t_sum > 0 and w_sum > 0:
+                            pbar0 = 0.0
+                            pbar1 = 0.0
+                            for t in range(m):
+                                pbar0 += taper[t] * p[sel_i[t], 0]
+                                pbar1 += taper[t] * p[sel_i[t], 1]
+                            pbar0 /= t_sum
+                            pbar1 /= t_sum
+                            sa = 0.0
+                            sb = 0.0
+                            sd = 0.0
+                            for t in range(m):
+                                h0 = p[sel_i[t], 0] - pbar0
+                                h1 = p[sel_i[t], 1] - pbar1
+                                sa += taper[t] * h0 * h0
+                                sb += taper[t] * h0 * h1
+                                sd += taper[t] * h1 * h1
+                            trace = sa + sd
+                            smallest = (trace - np.sqrt(max(trace * trace - 4 * (sa * sd - sb * sb), 0.0))) / 2
+                            spread = smallest / (support * support) if np.isfinite(support) else 0.0
+                            blend = min(max((spread - spread_min) / (spread_full - spread_min), 0.0), 1.0)
+
+                        t0 = 0.0
+                        t1 = 0.0
+                        if blend > 0:
+                            pstar0 = 0.0
+                            pstar1 = 0.0
+                            qstar0 = 0.0
+                            qstar1 = 0.0
+                            for t in range(m):
+                                i = sel_i[t]
+                                w[t] /= w_sum
+                                pstar0 += w[t] * p[i, 0]
+                                pstar1 += w[t] * p[i, 1]
+                                qstar0 += w[t] * q[i, 0]
+                                qstar1 += w[t] * q[i, 1]
+                            a = 0.0
+                            bb = 0.0
+                            d = 0.0
+                            for t in range(m):
+                                i = sel_i[t]
+                                phat0 = p[i, 0] - pstar0
+                                phat1 = p[i, 1] - pstar1
+                                a += w[t] * phat0 * phat0
+                                bb += w[t] * phat0 * phat1
+                                d += w[t] * phat1 * phat1
+                            det = a * d - bb * bb
+                            if abs(det) <= 1e-8 * (a + d) * (a + d):
+                                blend = 0.0
+                            else:
+                                m0 = v0 - pstar0
+                                m1 = v1 - pstar1
+                                l0 = (m0 * d - m1 * bb) / det
+                                l1 = (m1 * a - m0 * bb) / det
+                                t0 = qstar0
+                                t1 = qstar1
+                                for t in range(m):
+                                    i = sel_i[t]
+                                    A = (l0 * (p[i, 0] - pstar0) + l1 * (p[i, 1] - pstar1)) * w[t]
+                                    t0 += A * (q[i, 0] - qstar0)
+                                    t1 += A * (q[i, 1] - qstar1)
+
+                        # Global affine fit, row vector convention
+                        g0 = v0 * linear[0, 0] + v1 * linear[1, 0] + offset[0]
+                        g1 = v0 * linear[0, 1] + v1 * linear[1, 1] + offset[1]
+                        transformers[0, r, c] = blend * t0 + (1 - blend) * g0
+                        transformers[1, r, c] = blend * t1 + (1 - blend) * g1
+
+    @njit(parallel=True, cache=True)
+    def _remap(image, field, order, fill, tol, integer, out):
+        height, width, channels = image.shape
+        grow = field.shape[1]
+        gcol = field.shape[2]
+        for r in prange(grow):
+            for c in range(gcol):
+                sr = field[0, r, c]
+                sc = field[1, r, c]
+                if not (sr >= -tol and sr <= height - 1 + tol and sc >= -tol and sc <= width - 1 + tol):
+                    for k in range(channels):
+                        out[r, c, k] = fill[k]
+                    continue
+                sr = min(max(sr, 0), height - 1)
+                sc = min(max(sc, 0), width - 1)
+                if order == 0:
+                    r0 = np.int32(np.floor(sr + 0.5))
+                    c0 = np.int32(np.floor(sc + 0.5))
+                    for k in range(channels):
+                        out[r, c, k] = image[r0, c0, k]
+                else:
+                    r0 = min(np.int32(sr), max(height - 2, 0))
+                    c0 = min(np.int32(sc), max(width - 2, 0))
+                    r1 = min(r0 + 1, height - 1)
+                    c1 = min(c0 + 1, width - 1)
+                    fr = np.float32(sr - r0)
+                    fc = np.float32(sc - c0)
+                    for k in range(channels):
+                        top = image[r0, c0, k] * (1 - fc) + image[r0, c1, k] * fc
+                        bottom = image[r1, c0, k] * (1 - fc) + image[r1, c1, k] * fc
+                        value = top * (1 - fr) + bottom * fr
+                        # Integer images are rounded to the nearest level
+                        out[r, c, k] = np.floor(value + 0.5) if integer else value
+
+
+    @njit(parallel=True, cache=True)
+    def _classify(image, bins, boundary, bits, labels):
+        shift = 8 - bits
+        mask = (1 << shift) - 1
+        for r in prange(image.shape[0]):
+            for c in range(image.shape[1]):
+                red = np.uint32(image[r, c, 0])
+                green = np.uint32(image[r, c, 1])
+                blue = np.uint32(image[r, c, 2])
+                label = bins[((red >> shift) << (2 * bits)) | ((green >> shift) << bits) | (blue >> shift)]
+                if label >= 256:
+                    # Bin cut by a class boundary, looked up exactly
+                    label = boundary[label - 256, ((red & mask) << (2 * shift)) | ((green & mask) << shift)
+                                     | (blue & mask)]
+                labels[r, c] = label
+
+
+def mls_affine_field(vy, vx, p, q, alpha=1.0, eps=1e-8):
+    '''
+    Numba version of he_script.mls_affine_field, same arguments and output.
+    Both accumulate in float32 but in a different order, so results agree to
+    float32 rounding rather than bit for bit.
+    '''
+    # The kernels index q with p's length and do not check bounds
+    assert p.shape == q.shape and p.ndim == 2 and p.shape[1] == 2, 'p and q must be matching (n, 2) control points'
+
+    # Change (x, y) to (row, col) and exchange p and q, as in he_script
+    q = np.ascontiguousarray(q[:, [1, 0]], dtype=np.float32)
+    p = np.ascontiguousarray(p[:, [1, 0]], dtype=np.float32)
+    p, q = q, p
+
+    transformers = np.empty((2,) + vx.shape, np.float32)
+    _mls_affine_field(vy, vx, p, q, np.float32(alpha), np.float32(eps), transformers)
+    return transformers
+
+
+def local_mls_affine_field(vy, vx, p, q, alpha=1.0, eps=1e-8, k=None, radius=None, max_neighbours=32, block=16):
+    '''
+    Numba version of he_script.local_mls_affine_field, same arguments and
+    output. The candidate control points are looked up once per block of
+    block x block pixels in a k-d tree, within the block centre's (k+1)th
+    neighbour distance (or radius) plus the block diagonal, so they include
+    the nearest control points of every pixel of the block.
+    '''
+    from scipy.spatial import cKDTree
+    from transform import AffineTransform, SPREAD_MIN, SPREAD_FULL
+
+    assert p.shape == q.shape and p.ndim == 2 and p.shape[1] == 2, 'p and q must be matching (n, 2) control points'
+    if radius is None and k >= p.shape[0]:
+        # Every control point is a neighbour, nothing to taper
+        return mls_affine_field(vy, vx, p, q, alpha=alpha, eps=eps)
+
+    # Change (x, y) to (row, col) and exchange p and q, as in he_script
+    p, q = (np.ascontiguousarray(q[:, [1, 0]], dtype=np.float64),
+            np.ascontiguousarray(p[:, [1, 0]], dtype=np.float64))
+    affine = AffineTransform.fit(p, q)
+
+    # Centre and half diagonal of every block
+    grow, gcol = vx.shape
+    rows, cols = vx[:, 0].astype(np.float64), vy[0, :].astype(np.float64)
+    row_lo, col_lo = rows[::block], cols[::block]
+    row_hi = rows[np.minimum(np.arange(len(row_lo)) * block + block - 1, grow - 1)]
+    col_hi = cols[np.minimum(np.arange(len(col_lo)) * block + block - 1, gcol - 1)]
+    centre_r, centre_c = np.meshgrid((row_lo + row_hi) / 2, (col_lo + col_hi) / 2, indexing='ij')
+    half_r, half_c = np.meshgrid((row_hi - row_lo) / 2, (col_hi - col_lo) / 2, indexing='ij')
+    centres = np.stack([centre_r.ravel(), centre_c.ravel()], axis=1)
+    half_diagonal = np.hypot(half_r, half_c).ravel()
+
+    tree = cKDTree(p)
+    limit = np.inf if radius is None else radius
+    if k is None:
+        reach = limit + half_diagonal
+    else:
+        kth_dist = tree.query(centres, k=k + 1)[0][:, -1]
+        reach = np.minimum(kth_dist + 2 * half_diagonal, limit + half_diagonal)
+    found = tree.query_ball_point(centres, reach)
+    offsets = np.zeros(len(found) + 1, np.int64)
+    offsets[1:] = np.cumsum([len(f) for f in found])
+    candidates = np.fromiter((i for f in found for i in f), np.int64, offsets[-1])
+
+    transformers = np.empty((2,) + vx.shape, np.float32)
+    n_keep = max_neighbours if k is None else k + 1
+    _local_mls_affine_field(vy, vx, p, q, np.float64(alpha), np.float64(eps), n_keep, k is not None,
+                            np.float64(limit), block, offsets, candidates, affine.linear, affine.offset,
+                            SPREAD_MIN, SPREAD_FULL, transformers)
+    return transformers
+
+
+def remap(image, field, order, fill, tol, out):
+    '''
+    Numba version of warp.remap, image and out must have a channel axis and
+    fill one value per channel
+    '''
+    integer = bool(np.issubdtype(out.dtype, np.integer))
+    _remap(image, np.ascontiguousarray(field, dtype=np.float32), order, fill, np.float32(tol), integer, out)
+    return out
+
+
+def classify(image, bins, boundary, bits, labels):
+    '''
+    Numba version of colour_classes.classify, writes into labels
+    '''
+    _classify(image, bins, boundary, bits, labels)
+    return labels
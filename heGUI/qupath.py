@@ -0,0 +1,75 @@
+"""
+Reading of annotations exported from QuPath as GeoJSON, so they can be mapped
+through the alignment without being burnt into the H&E image.
+
+@Author: Nina Tubau & Kenta Yokote
+"""
+
+import json
+from typing import List, Tuple
+
+import numpy as np
+
+
+def read_geojson_rois(path: str) -> List[Tuple[np.ndarray, str]]:
+    '''
+    Reads the annotations of a QuPath "Export objects as GeoJSON" file.
+    Detections, cells, TMA cores and other objects of an "all objects" export
+    are skipped; features without an object type, as written by other tools,
+    are read as annotations.
+    :param path: GeoJSON file holding a FeatureCollection, a list of features
+        or a single feature
+    :return: list of ((n,2) vertices in full resolution H&E pixels (x, y),
+        classification name or None), one per polygon
+    :raises ValueError: if the file is not valid JSON or an annotation is not
+        a polygon, FOVs can only be placed over an area
+    '''
+    with open(path) as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise ValueError(f'{path} is not a valid GeoJSON file: {e}')
+
+    if isinstance(data, dict) and data.get('type') == 'FeatureCollection':
+        features = data['features']
+    elif isinstance(data, list):
+        features = data
+    else:
+        features = [data]
+
+    rois = []
+    for i, feature in enumerate(features):
+        properties = feature.get('properties') or {}
+        if not _is_annotation(feature, properties):
+            continue
+        classification = properties.get('classification') or {}
+        name = classification.get('name')
+        for vertices in _outer_rings(feature.get('geometry') or {}, f'{path}, feature {i + 1}'):
+            rois.append((np.asarray(vertices, dtype=np.float64)[:, :2], name))
+    return rois
+
+
+def _is_annotation(feature, properties):
+    # QuPath 0.3 and later give the object type in the properties, 0.2 its
+    # class name as the id
+    if 'objectType' in properties:
+        return properties['objectType'] == 'annotation'
+    if isinstance(feature.get('id'), str) and feature['id'].endswith('Object'):
+        return feature['id'] == 'PathAnnotationObject'
+    return True
+
+
+def _outer_rings(geometry, where):
+    '''
+    :return: vertex lists outlining every polygon of a GeoJSON geometry, holes
+        are ignored since only the bounding boxes are used
+    '''
+    kind = geometry.get('type')
+    coordinates = geometry.get('coordinates')
+    if kind == 'Polygon':
+        return [coordinates[0]]
+    if kind == 'MultiPolygon':
+        return [polygon[0] for polygon in coordinates]
+    if kind == 'GeometryCollection':
+        return [ring for part in geometry['geometries'] for ring in _outer_rings(part, where)]
+    raise ValueError(f'{where}: {kind} geometry has no area, only polygon annotations can be imported as FOVs')
@@ -0,0 +1,218 @@
+"""
+State of a single slide in a heGUI session. Every slide in the queue keeps
+its own form inputs, images, landmarks, transforms and FOV list, so several
+slides can be prepared in one session and each saves to its own JSON file.
+
+@Author: Nina Tubau & Kenta Yokote
+"""
+
+import os
+from typing import Dict
+
+import numpy as np
+
+# From this many landmarks on, every pixel only uses its LOCAL_MLS_NEIGHBOURS
+# nearest landmarks, so dense landmark sets align in about constant time.
+# Measured crossovers with the global field, per kernels.BACKEND.
+LOCAL_MLS_MIN_LANDMARKS = {'numba': 48, 'numpy': 96}
+LOCAL_MLS_NEIGHBOURS = 16
+
+
+class Slide:
+
+    def __init__(self, inputs: Dict) -> None:
+        '''
+        :param inputs: form entries of the slide, as returned by
+            heGUI.get_form_inputs
+        '''
+        self.inputs = inputs
+
+        self.source_image = None
+        self.target_image = None
+        self.he_shape = None
+        self._loading = None
+        self._loading_paths = None
+
+        # napari layers, kept so the points survive switching slides
+        self.source_points = None
+        self.target_points = None
+        self.test_points_min = None
+        self.test_points_max = None
+
+        self._aligned = None
+        self._detection = None
+        self._detection_roi_only = False
+
+        self.colour_classes = None
+        self.stage_transform = None
+        # RMS of the stage fit, shown again when the slide is reopened
+        self.stage_rms = None
+        self.options = None
+        self.optical_placed = False
+        self.he_placed = False
+        self.checked = False
+        self.saved = False
+
+    @property
+    def name(self) -> str:
+        return f"{self.inputs['file_naming_convention']} slide{self.inputs['slide_num']}"
+
+    @property
+    def status(self) -> str:
+        if self.saved:
+            return 'Saved'
+        if self.options is not None:
+            return 'FOVs checked'
+        if self.checked:
+            return 'Annotations checked'
+        if self._detection is not None:
+            if not self._detection.done():
+                return 'Detecting annotations'
+            if self._detection.exception() is not None:
+                return 'Detection failed'
+            return 'Annotations detected'
+        if self.optical_placed and self.he_placed:
+            return 'Landmarks placed'
+        if self._loading is None:
+            return 'Waiting for images'
+        if not self._loading.done():
+            return 'Loading'
+        if self._loading.exception() is not None:
+            return 'Loading failed'
+        return 'Loaded'
+
+    def get_output_file_name(self) -> str:
+        return os.path.join(self.inputs['output_folder'],
+                            self.inputs['file_naming_convention'] + "_" + f"slide{self.inputs['slide_num']}" + "_" + self.inputs['fov'] + ".json")
+
+    def start_loading(self, executor) -> None:
+        '''
+        Reads and resizes the slide's images in the background, again only if
+        the image paths changed since the last call
+        :param executor: concurrent.futures executor running the load
+        '''
+        paths = (self.inputs['optical_image'], self.inputs['he_image'])
+        if len(paths[0]) == 0 or len(paths[1]) == 0:
+            return
+        if paths == self._loading_paths and not (self._loading.done() and self._loading.exception() is not None):
+            return
+        self._loading_paths = paths
+        self._loading = executor.submit(self._load, *paths)
+
+    def _load(self, optical_image, he_image):
+        from skimage import io, img_as_ubyte
+        import he_script
+
+        source_image = io.imread(optical_image)
+        # Colour classes are defined on 8-bit RGB, 16-bit H&E files are scaled down once here
+        he = img_as_ubyte(io.imread(he_image))
+        return source_image, he_script.resize_(source_image, he), he.shape
+
+    def wait_loaded(self, executor) -> None:
+        '''
+        Blocks until the images are loaded, re-raising any loading error
+        '''
+        self.start_loading(executor)
+        self.source_image, self.target_image, self.he_shape = self._loading.result()
+
+    def landmarks(self):
+        '''
+        :return: (n,2) H&E and (n,2) optical landmarks in (x, y)
+        :raises ValueError: if the points layers do not hold the same number
+            of landmarks, at least three
+        '''
+        if self.target_points is None or self.source_points is None:
+            raise ValueError('Landmarks not placed')
+        pts_ref = np.flip(self.target_points.data, axis=1)
+        pts_mov = np.flip(self.source_points.data, axis=1)
+        if len(pts_ref) != len(pts_mov):
+            raise ValueError(f'{len(pts_mov)} optical and {len(pts_ref)} H&E landmarks placed, '
+                             'every landmark needs its match on the other image')
+        if len(pts_ref) < 3:
+            raise ValueError('At least three landmarks are needed on each image')
+        return pts_ref, pts_mov
+
+    def mls_neighbours(self, pts_ref):
+        '''
+        :return: number of nearest landmarks used per pixel, None for all
+        '''
+        import kernels
+
+        return LOCAL_MLS_NEIGHBOURS if len(pts_ref) >= LOCAL_MLS_MIN_LANDMARKS[kernels.BACKEND] else None
+
+    def he_to_optical(self):
+        '''
+        :return: transform from full resolution H&E pixels (x, y) to optical
+            pixels, through the resize and the landmark MLS mapping
+        '''
+        from transform import MLSTransform, scale_transform
+
+        pts_ref, pts_mov = self.landmarks()
+        mls = MLSTransform(pts_ref, pts_mov, k=self.mls_neighbours(pts_ref))
+        return scale_transform(self.he_shape, self.target_image.shape).compose(mls)
+
+    def aligned_levels(self):
+        '''
+        :return: lazily aligned H&E pyramid and its annotation class labels
+            for the current landmarks and colour classes, shared by the viewer
+            and the detection so computed tiles are reused
+        '''
+        import he_script
+        from colour_classes import load_colour_classes
+
+        pts_ref, pts_mov = self.landmarks()
+        key = (pts_ref.tobytes(), pts_mov.tobytes(), self.inputs['colour_classes'])
+        if self._aligned is None or self._aligned[0] != key:
+            self.colour_classes = load_colour_classes(self.inputs['colour_classes'])
+            transformed_levels = he_script.lazy_align_images(self.target_image, pts_ref, pts_mov,
+                                                                    k=self.mls_neighbours(pts_ref))
+            annotation_levels = he_script.lazy_annotation_labels(transformed_levels, self.colour_classes)
+            self._aligned = (key, transformed_levels, annotation_levels)
+            self._detection = None
+        return self._aligned[1], self._aligned[2]
+
+    def start_detection(self, executor, n_annots):
+        '''
+        Warps the H&E and finds the annotation corners in the background for
+        the current landmarks. An earlier detection for the same landmarks is
+        reused, unless it failed. With the roi_only input, only the regions
+        around annotation candidates are warped.
+        :param executor: concurrent.futures executor running the detection
+        :param n_annots: number of patients on the slide
+        :return: future of the (n,4) corners and their (n,) class labels
+        '''
+        _, annotation_levels = self.aligned_levels()
+        roi_only = self.inputs.get('roi_only', False)
+        failed = self._detection is not None and self._detection.done() and self._detection.exception() is not None
+        if self._detection is None or failed or self._detection_roi_only != roi_only:
+            self._detection_roi_only = roi_only
+            if roi_only:
+                # Read here, the points layers may change while the detection runs
+                pts_ref, pts_mov = self.landmarks()
+                self._detection = executor.submit(self._detect_rois, pts_ref, pts_mov, self.colour_classes, n_annots)
+            else:
+                self._detection = executor.submit(self._detect, annotation_levels[0], n_annots)
+        return self._detection
+
+    def _detect(self, annotation_labels, n_annots):
+        import he_script
+
+        labels = np.asarray(annotation_labels)
+        contours = he_script.get_annotation_regions(labels)
+        return he_script.get_corners(contours, n_annots, labels)
+
+    def _detect_rois(self, pts_ref, pts_mov, colour_classes, n_annots):
+        import he_script
+
+        return he_script.get_roi_annotation_corners(self.target_image, pts_ref, pts_mov, n_annots,
+                                                    colour_classes, k=self.mls_neighbours(pts_ref))
+
+    def fov_sizes(self, colour_class, default_fov_size):
+        '''
+        :param colour_class: (n,) class labels of the annotations
+        :param default_fov_size: FOV size selected in the GUI
+        :return: (n,) FOV size of every annotation
+        '''
+        sizes = [default_fov_size] + [default_fov_size if c.fov_size is None else c.fov_size
+                                      for c in self.colour_classes]
+        return np.array(sizes)[np.asarray(colour_class, dtype=int)]
@@ -0,0 +1,323 @@
+"""
+Coordinate transforms between the H&E image, the optical image and the stage
+(SED) space.
+
+Every transform maps (n, 2) arrays of (x, y) points in a single vectorised
+call and can be chained with ``compose`` so that, for example, H&E annotation
+vertices can be sent straight to stage microns.
+
+@Author: Nina Tubau & Kenta Yokote
+"""
+
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+
+class Transform(ABC):
+
+    @abstractmethod
+    def apply(self, points: np.ndarray) -> np.ndarray:
+        '''
+        :param points: (n, 2) points in (x, y)
+        :return: (n, 2) transformed points
+        '''
+
+    def __call__(self, points: np.ndarray) -> np.ndarray:
+        return self.apply(points)
+
+    def compose(self, other: 'Transform') -> 'ComposedTransform':
+        '''
+        :param other: transform applied after this one
+        :return: transform equivalent to other(self(points))
+        '''
+        return ComposedTransform([self, other])
+
+
+class AffineTransform(Transform):
+
+    def __init__(self, matrix: np.ndarray, src: np.ndarray = None, dst: np.ndarray = None) -> None:
+        '''
+        :param matrix: (3, 3) homogeneous matrix acting on row vectors, i.e.
+            [x', y', 1] = [x, y, 1] @ matrix
+        :param src: points the matrix was fitted from, if any
+        :param dst: points the matrix was fitted to, if any
+        '''
+        self.matrix = np.array(matrix, dtype=np.float64)
+        self.matrix[:, 2] = (0, 0, 1)
+        # Split once so apply() never has to pad the input points
+        self.linear = np.ascontiguousarray(self.matrix[:2, :2])
+        self.offset = self.matrix[2, :2].copy()
+        self.src = src
+        self.dst = dst
+        self._inverse = None
+
+    @classmethod
+    def fit(cls, src: np.ndarray, dst: np.ndarray) -> 'AffineTransform':
+        '''
+        Least squares affine fit from N >= 3 point pairs
+        :param src: (n, 2) points in the source space
+        :param dst: (n, 2) matching points in the destination space
+        :return: fitted transform
+        '''
+        src = np.asarray(src, dtype=np.float64)
+        dst = np.asarray(dst, dtype=np.float64)
+        assert src.shape == dst.shape and src.shape[0] >= 3, 'At least three matching point pairs are needed'
+
+        padded = np.hstack([src, np.ones((src.shape[0], 1))])
+        solution, _, rank, _ = np.linalg.lstsq(padded, dst, rcond=None)
+        assert rank == 3, 'Points are collinear, the affine transform is undefined'
+
+        matrix = np.zeros((3, 3))
+        matrix[:, :2] = solution
+        return cls(matrix, src, dst)
+
+    @property
+    def inverse(self) -> 'AffineTransform':
+        if self._inverse is None:
+            self._inverse = AffineTransform(np.linalg.inv(self.matrix), self.dst, self.src)
+            self._inverse._inverse = self
+        return self._inverse
+
+    def compose(self, other: Transform) -> Transform:
+        # Two affine maps collapse into a single matrix product
+        if isinstance(other, AffineTransform):
+            return AffineTransform(self.matrix @ other.matrix)
+        return super().compose(other)
+
+    def apply(self, points: np.ndarray) -> np.ndarray:
+        out = np.asarray(points, dtype=np.float64) @ self.linear
+        out += self.offset
+        return out
+
+    @property
+    def residuals(self) -> np.ndarray:
+        '''
+        :return: (n,) euclidean distance between each transformed source point
+            and its destination point
+        '''
+        if self.src is None:
+            return np.empty(0)
+        return np.linalg.norm(self.apply(self.src) - self.dst, axis=1)
+
+    @property
+    def rms(self) -> float:
+        residuals = self.residuals
+        if residuals.size == 0:
+            return 0.0
+        return float(np.sqrt(np.mean(residuals ** 2)))
+
+
+class MLSTransform(Transform):
+
+    def __init__(self, p: np.ndarray, q: np.ndarray, alpha: float = 1.0, eps: float = 1e-8, batch_size: int = 65536,
+                    k: int = None, radius: float = None, max_neighbours: int = 32) -> None:
+        '''
+        Moving least squares affine deformation evaluated at arbitrary points
+        :param p: (n, 2) control points in the source space
+        :param q: (n, 2) matching control points in the destination space
+        :param alpha: parameter used by weights
+        :param eps: epsilon
+        :param batch_size: number of points evaluated at once, bounds the
+            (batch, n) temporaries
+        :param k: if given, only the k nearest control points of every point
+            are used, their weights tapered to zero at the (k+1)th nearest so
+            the mapping stays continuous
+        :param radius: if given, only control points within radius are used,
+            their weights tapered to zero at radius
+        :param max_neighbours: most control points used per point when only
+            radius is given
+
+        With k or radius, points whose weighted neighbours are too few or too
+        collinear to fix a local affine map (see local_blend) blend into
+        the global affine fit of p to q.
+        '''
+        self.p = np.asarray(p, dtype=np.float64)
+        self.q = np.asarray(q, dtype=np.float64)
+        self.alpha = alpha
+        self.eps = eps
+        self.batch_size = batch_size
+        self.k = k
+        self.radius = radius
+        self.max_neighbours = max_neighbours
+        self._tree = None
+        self._affine = None
+
+    @property
+    def local(self) -> bool:
+        return self.k is not None or self.radius is not None
+
+    @property
+    def inverse(self) -> 'MLSTransform':
+        # Swapping the control points gives the approximate inverse mapping
+        return MLSTransform(self.q, self.p, self.alpha, self.eps, self.batch_size,
+                            self.k, self.radius, self.max_neighbours)
+
+    @property
+    def affine(self) -> AffineTransform:
+        '''
+        :return: global least squares affine fit of the control points, used
+            where the local weights vanish
+        '''
+        if self._affine is None:
+            self._affine = AffineTransform.fit(self.p, self.q)
+        return self._affine
+
+    def apply(self, points: np.ndarray) -> np.ndarray:
+        points = np.asarray(points, dtype=np.float64)
+        out = np.empty_like(points)
+        apply_batch = self._apply_local_batch if self.local else self._apply_batch
+        for start in range(0, points.shape[0], self.batch_size):
+            stop = start + self.batch_size
+            out[start:stop] = apply_batch(points[start:stop])
+        return out
+
+    def _apply_batch(self, v: np.ndarray) -> np.ndarray:
+        p, q = self.p, self.q
+
+        w = 1.0 / (np.sum((v[:, None, :] - p[None]) ** 2, axis=2) + self.eps) ** self.alpha    # [n, ctrls]
+        w /= np.sum(w, axis=1, keepdims=True)
+
+        pstar = w @ p                                                                       # [n, 2]
+        qstar = w @ q                                                                       # [n, 2]
+        phat = p[None] - pstar[:, None]                                                     # [n, ctrls, 2]
+        qhat = q[None] - qstar[:, None]                                                     # [n, ctrls, 2]
+
+        out, singular = _solve(v, w, pstar, qstar, phat, qhat)
+        # Where pTwp is singular only the translation of the centroids is used
+        out[singular] = v[singular] - pstar[singular] + qstar[singular]
+        return out
+
+    def _apply_local_batch(self, v: np.ndarray) -> np.ndarray:
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+            self._tree = cKDTree(self.p)
+        if self.radius is None and self.k >= self.p.shape[0]:
+            # Every control point is a neighbour, nothing to taper
+            return self._apply_batch(v)
+
+        # Nearest control points of every point, missing ones at infinite distance
+        n_query = self.max_neighbours if self.k is None else self.k + 1
+        upper_bound = np.inf if self.radius is None else self.radius
+        dist, idx = self._tree.query(v, k=n_query, distance_upper_bound=upper_bound)
+        dist = dist.reshape(v.shape[0], -1)
+        idx = idx.reshape(v.shape[0], -1)
+        if self.k is None:
+            support = np.full(v.shape[0], upper_bound)
+        else:
+            # The (k+1)th neighbour only sets where the weights reach zero
+            support = np.minimum(dist[:, -1], upper_bound)
+            dist, idx = dist[:, :-1], idx[:, :-1]
+
+        found = np.isfinite(dist)
+        dist = np.where(found, dist, 0)
+        idx = np.where(found, idx, 0)
+        taper = np.where(found, wendland(dist / support[:, None]), 0)                      # [n, k]
+
+        w = taper / (dist ** 2 + self.eps) ** self.alpha
+        w_sum = np.sum(w, axis=1, keepdims=True)
+        w = np.divide(w, w_sum, out=np.zeros_like(w), where=w_sum > 0)
+
+        p, q = self.p[idx], self.q[idx]                                                     # [n, k, 2]
+        pstar = np.einsum('nc,nci->ni', w, p)                                               # [n, 2]
+        qstar = np.einsum('nc,nci->ni', w, q)                                               # [n, 2]
+        out, singular = _solve(v, w, pstar, qstar, p - pstar[:, None], q - qstar[:, None])
+
+        # Blend into the global affine fit as the neighbours become too few or
+        # too collinear to fix a local affine map
+        local = local_blend(taper, p, support)
+        local[singular] = 0
+        blend = local < 1
+        if np.any(blend):
+            global_ = self.affine.apply(v[blend])
+            out[blend] = local[blend, None] * out[blend] + (1 - local[blend, None]) * global_
+        return out
+
+
+# Spread of the tapered neighbours (see local_blend) below which a local fit
+# is blended into the global affine fit, and from which it is used alone
+SPREAD_MIN = 0.001
+SPREAD_FULL = 0.01
+
+
+def wendland(r):
+    '''
+    :param r: distances over the support
+    :return: Wendland taper (1 - r) ** 4 (4 r + 1), 1 at 0 and falling
+        smoothly to 0 at 1 and beyond
+    '''
+    t = np.clip(1 - r, 0, None)
+    return t ** 4 * (4 * r + 1)
+
+
+def local_blend(taper, p, support):
+    '''
+    :param taper: (n, k) taper of every neighbour
+    :param p: (n, k, 2) neighbours
+    :param support: (n,) distance at which the tapers reach 0
+    :return: (n,) weight of the local fit against the global affine fit,
+        ramping from SPREAD_MIN to SPREAD_FULL of the smallest eigenvalue of
+        the taper weighted scatter of the neighbours over support ** 2. It
+        falls continuously to 0 as neighbours leave the support or line up.
+    '''
+    t_sum = np.sum(taper, axis=1)
+    pbar = np.einsum('nc,nci->ni', taper, p) / np.maximum(t_sum, 1e-300)[:, None]
+    phat = p - pbar[:, None]
+    scatter = np.einsum('nc,nci,ncj->nij', taper, phat, phat)
+    trace = scatter[:, 0, 0] + scatter[:, 1, 1]
+    det = scatter[:, 0, 0] * scatter[:, 1, 1] - scatter[:, 0, 1] * scatter[:, 1, 0]
+    smallest = (trace - np.sqrt(np.maximum(trace ** 2 - 4 * det, 0))) / 2
+    spread = smallest / support ** 2
+    return np.clip((spread - SPREAD_MIN) / (SPREAD_FULL - SPREAD_MIN), 0, 1)
+
+
+def _solve(v, w, pstar, qstar, phat, qhat):
+    '''
+    :return: (n, 2) moving least squares affine mapping of v from the
+        weights, centroids and centred control points, and (n,) whether pTwp
+        is singular, in which case the mapping is left at qstar
+    '''
+    pTwp = np.einsum('nc,nci,ncj->nij', w, phat, phat)                                      # [n, 2, 2]
+    pTwq = np.einsum('nc,nci,ncj->nij', w, phat, qhat)                                      # [n, 2, 2]
+
+    det = pTwp[:, 0, 0] * pTwp[:, 1, 1] - pTwp[:, 0, 1] * pTwp[:, 1, 0]
+    # Relative to the scale of pTwp, two control points are collinear however far apart
+    trace = pTwp[:, 0, 0] + pTwp[:, 1, 1]
+    singular = np.abs(det) <= 1e-8 * trace ** 2
+    pTwp[singular] = np.eye(2)
+    pTwq[singular] = 0
+
+    M = np.linalg.solve(pTwp, pTwq)                                                         # [n, 2, 2]
+    return np.einsum('ni,nij->nj', v - pstar, M) + qstar, singular
+
+
+class ComposedTransform(Transform):
+
+    def __init__(self, transforms) -> None:
+        self.transforms = []
+        for transform in transforms:
+            if isinstance(transform, ComposedTransform):
+                self.transforms.extend(transform.transforms)
+            else:
+                self.transforms.append(transform)
+
+    @property
+    def inverse(self) -> 'ComposedTransform':
+        return ComposedTransform([t.inverse for t in reversed(self.transforms)])
+
+    def apply(self, points: np.ndarray) -> np.ndarray:
+        for transform in self.transforms:
+            points = transform.apply(points)
+        return points
+
+
+def scale_transform(from_shape, to_shape) -> AffineTransform:
+    '''
+    :param from_shape: shape of the image the points are given in
+    :param to_shape: shape of the image the points should be mapped to
+    :return: transform rescaling (x, y) points between the two images
+    '''
+    matrix = np.eye(3)
+    matrix[0, 0] = to_shape[1] / from_shape[1]
+    matrix[1, 1] = to_shape[0] / from_shape[0]
+    return AffineTransform(matrix)
@@ -0,0 +1,265 @@
+"""
+Remapping of images through a deformation field, used to align the H&E image
+onto the optical image.
+
+@Author: Nina Tubau & Kenta Yokote
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import kernels
+
+# Distance in pixels a coordinate may fall outside the image and still be
+# sampled from the border, absorbs float32 rounding of the deformation field
+BORDER_TOLERANCE = 1e-3
+
+
+def remap(image, field, order=1, fill_value=0, out=None):
+    '''
+    Samples image at the (row, col) coordinates given by field, channel by
+    channel and without changing the dtype
+    :param image: (rows, cols) or (rows, cols, channels) image to sample from
+    :param field: (2, grow, gcol) float source row and column of every output pixel
+    :param order: 0 for nearest neighbour, 1 for bilinear sampling
+    :param fill_value: scalar or per channel value of output pixels whose
+        source falls outside image
+    :param out: optional (grow, gcol[, channels]) array to write into
+    :return: out
+    '''
+    assert order in (0, 1), 'Only nearest (0) and bilinear (1) sampling are supported'
+    grow, gcol = field.shape[1:]
+    if out is None:
+        out = np.empty((grow, gcol) + image.shape[2:], image.dtype)
+
+    # Work on (rows, cols, channels) views so grey images share the code path
+    image3 = image.reshape(image.shape[:2] + (-1,))
+    out3 = out.reshape((grow, gcol, -1))
+    fill = np.broadcast_to(np.asarray(fill_value, dtype=out.dtype), (out3.shape[2],))
+
+    if kernels.BACKEND == 'numba':
+        kernels.remap(image3, field, order, np.ascontiguousarray(fill), BORDER_TOLERANCE, out3)
+        return out
+
+    height, width = image.shape[:2]
+    rows, cols = field[0], field[1]
+    tol = BORDER_TOLERANCE
+    valid = (rows >= -tol) & (rows <= height - 1 + tol) & (cols >= -tol) & (cols <= width - 1 + tol)
+    out3[~valid] = fill
+    rows = np.clip(rows[valid], 0, height - 1)
+    cols = np.clip(cols[valid], 0, width - 1)
+
+    if order == 0:
+        r0 = np.floor(rows + 0.5).astype(np.int32)
+        c0 = np.floor(cols + 0.5).astype(np.int32)
+        out3[valid] = image3[r0, c0]
+        return out
+
+    r0 = np.minimum(rows.astype(np.int32), max(height - 2, 0))
+    c0 = np.minimum(cols.astype(np.int32), max(width - 2, 0))
+    r1 = np.minimum(r0 + 1, height - 1)
+    c1 = np.minimum(c0 + 1, width - 1)
+    fr = (rows - r0).astype(np.float32)
+    fc = (cols - c0).astype(np.float32)
+    del rows, cols
+
+    integer = np.issubdtype(out.dtype, np.integer)
+    for k in range(image3.shape[2]):
+        channel = image3[..., k]
+        top = channel[r0, c0] * (1 - fc) + channel[r0, c1] * fc
+        bottom = channel[r1, c0] * (1 - fc) + channel[r1, c1] * fc
+        value = top * (1 - fr) + bottom * fr
+        # Integer images are rounded to the nearest level
+        out3[..., k][valid] = np.floor(value + 0.5) if integer else value
+
+    return out
+
+
+class LazyTiledImage:
+    '''
+    Read-only, array-like image whose tiles are computed on demand by
+    tile_fn(rows, cols) and kept in an LRU cache. napari accepts it wherever
+    it accepts a NumPy or dask array, including as a level of a multiscale
+    image, and only requests the tiles covering the current view.
+    '''
+
+    def __init__(self, tile_fn, shape, dtype, tile_size=512, cache_size=64) -> None:
+        '''
+        :param tile_fn: callable taking a row slice and a column slice and
+            returning the corresponding block of the image
+        :param shape: shape of the full image
+        :param dtype: dtype of the blocks returned by tile_fn
+        :param tile_size: side length of the square tiles
+        :param cache_size: number of computed tiles kept in memory
+        '''
+        self.tile_fn = tile_fn
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.tile_size = tile_size
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def chunks(self):
+        return (self.tile_size, self.tile_size) + self.shape[2:]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        block = self._read(0, self.shape[0], 0, self.shape[1])
+        return block if dtype is None else block.astype(dtype, copy=False)
+
+    def __getitem__(self, key):
+        '''
+        Supports integers, slices with any step, Ellipsis and integer arrays,
+        with NumPy semantics. Only the tiles spanned by the selected rows and
+        columns are computed.
+        '''
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = next(i for i, k in enumerate(key) if k is Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        if len(key) > self.ndim:
+            raise IndexError(f'too many indices: the image is {self.ndim}-dimensional, but {len(key)} were indexed')
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        # Read the block spanning the selection, then index it relative to its origin
+        r_lo, r_hi, row_key = _axis_span(key[0], self.shape[0])
+        c_lo, c_hi, col_key = _axis_span(key[1], self.shape[1])
+        if r_hi == r_lo or c_hi == c_lo:
+            block = np.empty((r_hi - r_lo, c_hi - c_lo) + self.shape[2:], self.dtype)
+        else:
+            block = self._read(r_lo, r_hi, c_lo, c_hi)
+        return block[(row_key, col_key) + tuple(key[2:])]
+
+    def _tile(self, i, j):
+        with self._lock:
+            if (i, j) in self._cache:
+                self._cache.move_to_end((i, j))
+                return self._cache[i, j]
+
+        rows = slice(i * self.tile_size, min((i + 1) * self.tile_size, self.shape[0]))
+        cols = slice(j * self.tile_size, min((j + 1) * self.tile_size, self.shape[1]))
+        tile = np.asarray(self.tile_fn(rows, cols), dtype=self.dtype)
+
+        with self._lock:
+            self._cache[i, j] = tile
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return tile
+
+    def _read(self, r0, r1, c0, c1):
+        out = np.empty((r1 - r0, c1 - c0) + self.shape[2:], self.dtype)
+        size = self.tile_size
+        for i in range(r0 // size, (r1 - 1) // size + 1):
+            for j in range(c0 // size, (c1 - 1) // size + 1):
+                tile = self._tile(i, j)
+                tr0, tc0 = i * size, j * size
+                rs, re = max(r0, tr0), min(r1, tr0 + tile.shape[0])
+                cs, ce = max(c0, tc0), min(c1, tc0 + tile.shape[1])
+                out[rs - r0:re - r0, cs - c0:ce - c0] = tile[rs - tr0:re - tr0, cs - tc0:ce - tc0]
+        return out
+
+
+def _axis_span(key, n):
+    '''
+    :return: first and past the last index selected by key along an axis of
+        length n, and key relative to the first index
+    :raises IndexError: for out of bounds indices and unsupported key types
+    '''
+    if isinstance(key, slice):
+        indices = range(*key.indices(n))
+        if len(indices) == 0:
+            return 0, 0, slice(0, 0)
+        lo = min(indices[0], indices[-1])
+        stop = indices[-1] - lo + (1 if indices.step > 0 else -1)
+        return lo, max(indices[0], indices[-1]) + 1, slice(indices[0] - lo, stop if stop >= 0 else None, indices.step)
+
+    if isinstance(key, (int, np.integer)) and not isinstance(key, (bool, np.bool_)):
+        index = int(key) + n if key < 0 else int(key)
+        if not 0 <= index < n:
+            raise IndexError(f'index {key} is out of bounds for axis with size {n}')
+        return index, index + 1, 0
+
+    index = np.asarray(key)
+    if index.dtype.kind not in 'iu':
+        raise IndexError(f'only integers, slices, Ellipsis and integer arrays are valid indices, '
+                         f'not {type(key).__name__}')
+    index = np.where(index < 0, index + n, index)
+    if np.any((index < 0) | (index >= n)):
+        raise IndexError(f'index {key} is out of bounds for axis with size {n}')
+    if index.size == 0:
+        return 0, 0, index
+    lo = int(index.min())
+    return lo, int(index.max()) + 1, index - lo
+
+
+def lazy_warp(image, field_fn, order=1, fill_value=0, tile_size=512, cache_size=64, min_size=None):
+    '''
+    Multiscale, tile-on-demand version of warping image through field_fn
+    :param image: (rows, cols[, channels]) image to warp
+    :param field_fn: callable taking the (vy, vx) column and row grids of
+        output pixels and returning the (2, grow, gcol) source coordinates,
+        as mls_affine_field does
+    :param order: 0 for nearest neighbour, 1 for bilinear sampling
+    :param fill_value: value of the pixels mapped from outside image
+    :param tile_size: side length of the tiles computed at once
+    :param cache_size: number of tiles cached per level
+    :param min_size: levels are halved until both sides fit in min_size,
+        defaults to tile_size
+    :return: list of LazyTiledImage, full resolution first
+    '''
+    min_size = tile_size if min_size is None else min_size
+    levels = []
+    downsample = 1
+    while True:
+        source = image[::downsample, ::downsample]
+        levels.append(LazyTiledImage(_warp_tile_fn(source, field_fn, downsample, order, fill_value),
+                                     source.shape, image.dtype, tile_size, cache_size))
+        if max(source.shape[:2]) <= min_size:
+            return levels
+        downsample = downsample * 2
+
+
+def _warp_tile_fn(source, field_fn, downsample, order, fill_value):
+
+    def warp_tile(rows, cols):
+        gridY = np.arange(rows.start, rows.stop, dtype=np.int32) * downsample
+        gridX = np.arange(cols.start, cols.stop, dtype=np.int32) * downsample
+        vy, vx = np.meshgrid(gridX, gridY)
+        field = field_fn(vy, vx)
+        if downsample > 1:
+            # Full resolution source coordinates to the strided source
+            field /= downsample
+        return remap(source, field, order=order, fill_value=fill_value)
+
+    return warp_tile
+
+
+def lazy_map(levels, fn, dtype, channel_axis=True):
+    '''
+    :param levels: list of LazyTiledImage
+    :param fn: callable applied to every computed tile
+    :param dtype: dtype returned by fn
+    :param channel_axis: False when fn drops the channel axis of the tiles
+    :return: list of LazyTiledImage computing fn on the tiles of levels
+    '''
+    mapped = []
+    for level in levels:
+        shape = level.shape if channel_axis else level.shape[:2]
+        tile_fn = lambda rows, cols, level=level: fn(level[rows, cols])
+        mapped.append(LazyTiledImage(tile_fn, shape, dtype, level.tile_size, level.cache_size))
+    return mapped
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The heGUI modules import each other by module name, as main.pyw runs them
+# from their own folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'heGUI'))
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from colour_classes import DEFAULT_COLOUR_CLASSES, ColourClass, build_lut, classify, classify_colours
+
+
+def test_default_class_matches_yellow_threshold():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (123, 456, 3), dtype=np.uint8)
+    expected = (image[..., 0] > 160) & (image[..., 1] > 100) & (image[..., 2] < 180)
+
+    np.testing.assert_array_equal(classify_colours(image), expected.astype(np.uint8))
+    np.testing.assert_array_equal(classify(image, build_lut(DEFAULT_COLOUR_CLASSES)), expected.astype(np.uint8))
+
+
+def test_rgb_box_fast_path_matches_lookup():
+    rng = np.random.default_rng(1)
+    image = rng.integers(0, 256, (100, 200, 3), dtype=np.uint8)
+    for colour_class in (ColourClass('box', rgb_min=(10, 0, 200), rgb_max=(255, 90, 255)),
+                         ColourClass('all')):
+        np.testing.assert_array_equal(classify_colours(image, [colour_class]),
+                                      classify(image, build_lut([colour_class])))
+
+
+def matching_labels(image, colour_classes):
+    rgb = image.reshape(-1, 3)
+    labels = np.zeros(rgb.shape[0], np.uint8)
+    for i in reversed(range(len(colour_classes))):
+        labels[colour_classes[i].matches(rgb)] = i + 1
+    return labels.reshape(image.shape[:2])
+
+
+@pytest.mark.parametrize('bits', [3, 5, 8])
+def test_lookup_is_exact_at_class_boundaries(bits):
+    colour_classes = (ColourClass('yellow', rgb_min=(161, 101, 0), rgb_max=(255, 255, 179)),
+                      ColourClass('blue', rgb_min=(0, 0, 150), rgb_max=(99, 120, 255)),
+                      ColourClass('green', hsv_min=(90, 0.3, 0.2), hsv_max=(150, 1, 1)))
+    # Every combination of the values on either side of the bounds
+    values = np.array([0, 98, 99, 100, 101, 102, 119, 120, 121, 149, 150, 151, 160, 161, 162, 178, 179, 180, 255],
+                      np.uint8)
+    image = np.stack(np.meshgrid(values, values, values, indexing='ij'), axis=-1).reshape(len(values), -1, 3)
+
+    np.testing.assert_array_equal(classify(image, build_lut(colour_classes, bits)),
+                                  matching_labels(image, colour_classes))
+
+
+def test_several_classes_lookup_stays_in_cache():
+    colour_classes = (ColourClass('yellow', rgb_min=(161, 101, 0), rgb_max=(255, 255, 179)),
+                      ColourClass('blue', rgb_min=(0, 0, 150), rgb_max=(99, 120, 255)))
+    bins, boundary = build_lut(colour_classes, 5)
+
+    # Only the bins cut by a bound of a box need the second level
+    assert bins.nbytes <= 64 * 1024
+    assert boundary.nbytes <= 4 * 1024 * 1024
@@ -0,0 +1,39 @@
+import numpy as np
+
+import he_script
+
+YELLOW = (220, 200, 50)
+
+
+def noisy_slide(rng, shape, boxes, n_specks):
+    image = np.full(shape + (3,), 120, np.uint8)
+    for r0, c0, r1, c1 in boxes:
+        image[r0:r1, c0:c0 + 4] = YELLOW
+        image[r0:r1, c1 - 4:c1] = YELLOW
+        image[r0:r0 + 4, c0:c1] = YELLOW
+        image[r1 - 4:r1, c0:c1] = YELLOW
+    image[rng.integers(0, shape[0], n_specks), rng.integers(0, shape[1], n_specks)] = YELLOW
+    return image
+
+
+def test_roi_corners_match_full_slide_on_noisy_slide(monkeypatch):
+    rng = np.random.default_rng(0)
+    image = noisy_slide(rng, (1200, 1800), [(150, 200, 450, 520), (700, 1100, 1050, 1500)], 400)
+    pts_ref = np.array([[50, 50], [1750, 80], [90, 1150], [1700, 1120], [900, 600.]])
+    pts_mov = pts_ref + np.array([[20, 10], [25, -5], [10, 15], [30, 0], [22, 8.]])
+
+    aligned = he_script.align_images(image, pts_ref, pts_mov)
+    regions, labels = he_script.get_annotation_coords(aligned)
+    corners, classes = he_script.get_corners(regions, 2, labels)
+
+    crops = []
+    aligned_boxes = he_script.aligned_boxes
+    monkeypatch.setattr(he_script, 'aligned_boxes', lambda *args, **kwargs: crops.append(
+        aligned_boxes(*args, **kwargs)) or crops[-1])
+    roi_corners, roi_classes = he_script.get_roi_annotation_corners(image, pts_ref, pts_mov, 2)
+
+    assert len(corners) == 2
+    np.testing.assert_array_equal(roi_corners, corners)
+    np.testing.assert_array_equal(roi_classes, classes)
+    # The specks are not warped, one crop per annotation
+    assert len(crops) == 1 and len(crops[0]) == 2
@@ -0,0 +1,134 @@
+"""
+Cross-checks of the Numba kernels against the NumPy implementations. Both
+accumulate in float32 in a different order, so the tolerances below are the
+differences accepted between the backends.
+"""
+
+import numpy as np
+import pytest
+
+import kernels
+import warp
+from colour_classes import ColourClass, build_lut, classify
+
+pytestmark = pytest.mark.skipif(kernels.BACKEND != 'numba', reason='Numba or a thread-safe threading layer is missing')
+
+# Source coordinates agree to float32 rounding accumulated over the control
+# points, relative to coordinates of up to about 1200 pixels
+FIELD_RTOL = 2e-5
+FIELD_ATOL = 1e-3
+# Bilinear samples differ by at most one grey level on a small fraction of pixels
+REMAP_MAX_DIFF = 1
+REMAP_MAX_FRACTION = 0.01
+
+
+@pytest.fixture
+def numpy_backend(monkeypatch):
+    def run(fn, *args, **kwargs):
+        with monkeypatch.context() as m:
+            m.setattr(kernels, 'BACKEND', 'numpy')
+            return fn(*args, **kwargs)
+    return run
+
+
+def landmarks(rng, n, shape):
+    pts_ref = rng.uniform(0, 1, (n, 2)) * (shape[1], shape[0])
+    pts_mov = pts_ref * 1.02 + rng.normal(0, 5, (n, 2)) + 10
+    return pts_ref, pts_mov
+
+
+def grid(rows, cols):
+    return np.meshgrid(np.arange(cols, dtype=np.int32), np.arange(rows, dtype=np.int32))
+
+
+@pytest.mark.parametrize('n', [3, 4, 20])
+def test_mls_affine_field(numpy_backend, n):
+    import he_script
+
+    rng = np.random.default_rng(n)
+    vy, vx = grid(300, 1200)
+    pts_ref, pts_mov = landmarks(rng, n, vx.shape)
+
+    expected = numpy_backend(he_script.mls_affine_field, vy, vx, pts_ref, pts_mov)
+    field = kernels.mls_affine_field(vy, vx, pts_ref, pts_mov)
+
+    assert field.dtype == expected.dtype == np.float32
+    assert field.shape == expected.shape == (2,) + vx.shape
+    np.testing.assert_allclose(field, expected, rtol=FIELD_RTOL, atol=FIELD_ATOL)
+
+
+@pytest.mark.parametrize('n, options', [(64, {'k': 16}), (64, {'radius': 100}), (200, {'k': 8, 'radius': 150}),
+                                        (10, {'k': 16})])
+def test_local_mls_affine_field(numpy_backend, n, options):
+    import he_script
+
+    rng = np.random.default_rng(n)
+    vy, vx = grid(300, 1200)
+    pts_ref, pts_mov = landmarks(rng, n, vx.shape)
+
+    expected = numpy_backend(he_script.local_mls_affine_field, vy, vx, pts_ref, pts_mov, **options)
+    field = kernels.local_mls_affine_field(vy, vx, pts_ref, pts_mov, **options)
+
+    assert field.dtype == expected.dtype == np.float32
+    np.testing.assert_allclose(field, expected, rtol=FIELD_RTOL, atol=FIELD_ATOL)
+
+
+@pytest.mark.parametrize('options', [{}, {'k': 4}])
+def test_mls_affine_field_rejects_unmatched_points(options):
+    rng = np.random.default_rng(0)
+    vy, vx = grid(30, 40)
+    pts_ref, pts_mov = landmarks(rng, 5, vx.shape)
+
+    fn = kernels.local_mls_affine_field if options else kernels.mls_affine_field
+    with pytest.raises(AssertionError):
+        fn(vy, vx, pts_ref, pts_mov[:4], **options)
+
+
+@pytest.fixture
+def image_and_field():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (300, 400, 3), dtype=np.uint8)
+    vy, vx = grid(300, 400)
+    # Smooth field reaching outside the image on the borders
+    field = np.stack([vx + 3.3 * np.sin(vy / 40.0) - 2, vy + 2.7 * np.cos(vx / 30.0) + 1.5]).astype(np.float32)
+    return image, field
+
+
+def test_remap_nearest(numpy_backend, image_and_field):
+    image, field = image_and_field
+    expected = numpy_backend(warp.remap, image, field, order=0, fill_value=7)
+    np.testing.assert_array_equal(warp.remap(image, field, order=0, fill_value=7), expected)
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.float32])
+def test_remap_bilinear(numpy_backend, image_and_field, dtype):
+    image, field = image_and_field
+    image = image.astype(dtype)
+    expected = numpy_backend(warp.remap, image, field, order=1, fill_value=7)
+    out = warp.remap(image, field, order=1, fill_value=7)
+
+    assert out.dtype == expected.dtype == dtype
+    diff = np.abs(out.astype(np.float64) - expected.astype(np.float64))
+    if np.issubdtype(dtype, np.integer):
+        assert diff.max() <= REMAP_MAX_DIFF
+        assert np.count_nonzero(diff) <= REMAP_MAX_FRACTION * diff.size
+    else:
+        np.testing.assert_allclose(out, expected, rtol=0, atol=1e-3)
+
+
+def test_remap_grey(numpy_backend, image_and_field):
+    image, field = image_and_field
+    grey = image[..., 0]
+    expected = numpy_backend(warp.remap, grey, field, order=0)
+    np.testing.assert_array_equal(warp.remap(grey, field, order=0), expected)
+
+
+@pytest.mark.parametrize('bits', [5, 8])
+def test_classify(numpy_backend, bits):
+    rng = np.random.default_rng(bits)
+    image = rng.integers(0, 256, (257, 389, 3), dtype=np.uint8)
+    lut = build_lut((ColourClass('yellow', rgb_min=(161, 101, 0), rgb_max=(255, 255, 179)),
+                     ColourClass('green', hsv_min=(90, 0.3, 0.2), hsv_max=(150, 1, 1))), bits)
+
+    expected = numpy_backend(classify, image, lut)
+    np.testing.assert_array_equal(classify(image, lut), expected)
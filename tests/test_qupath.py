@@ -0,0 +1,80 @@
+import json
+
+import numpy as np
+import pytest
+
+import he_script
+from colour_classes import ColourClass
+from qupath import read_geojson_rois
+from transform import MLSTransform, scale_transform
+
+SQUARE = [[[10, 20], [110, 20], [110, 70], [10, 70], [10, 20]]]
+TRIANGLE = [[[200, 300], [260, 300], [230, 350], [200, 300]]]
+
+
+def feature(geometry, object_type='annotation', classification='yellow'):
+    properties = {'objectType': object_type}
+    if classification is not None:
+        properties['classification'] = {'name': classification, 'colorRGB': -256}
+    return {'type': 'Feature', 'id': 'a0c6d1f2', 'geometry': geometry, 'properties': properties}
+
+
+def write(tmp_path, data):
+    path = tmp_path / 'annotations.geojson'
+    path.write_text(json.dumps(data))
+    return str(path)
+
+
+@pytest.mark.parametrize('wrap', [lambda features: {'type': 'FeatureCollection', 'features': features},
+                                  lambda features: features,
+                                  lambda features: features[0]])
+def test_feature_collection_list_and_single_feature(tmp_path, wrap):
+    features = [feature({'type': 'Polygon', 'coordinates': SQUARE})]
+    rois = read_geojson_rois(write(tmp_path, wrap(features)))
+
+    assert len(rois) == 1
+    np.testing.assert_array_equal(rois[0][0], SQUARE[0])
+    assert rois[0][1] == 'yellow'
+
+
+def test_multipolygon_and_missing_classification(tmp_path):
+    features = [feature({'type': 'MultiPolygon', 'coordinates': [SQUARE, TRIANGLE]}, classification=None)]
+    rois = read_geojson_rois(write(tmp_path, features))
+
+    assert [name for _, name in rois] == [None, None]
+    np.testing.assert_array_equal(rois[1][0], TRIANGLE[0])
+
+
+def test_only_annotations_are_read(tmp_path):
+    polygon = {'type': 'Polygon', 'coordinates': SQUARE}
+    features = [feature(polygon), feature(polygon, 'detection'), feature(polygon, 'cell'),
+                feature(polygon, 'tma_core'), dict(feature(polygon), id='PathDetectionObject', properties={})]
+    assert len(read_geojson_rois(write(tmp_path, features))) == 1
+
+
+@pytest.mark.parametrize('geometry', [{'type': 'Point', 'coordinates': [5, 5]},
+                                      {'type': 'MultiPoint', 'coordinates': [[5, 5], [9, 9]]},
+                                      {'type': 'LineString', 'coordinates': [[5, 5], [9, 9]]}])
+def test_annotations_without_area_are_rejected(tmp_path, geometry):
+    with pytest.raises(ValueError, match=geometry['type']):
+        read_geojson_rois(write(tmp_path, [feature(geometry)]))
+
+
+def test_roi_corners_map_vertices_through_the_alignment(tmp_path):
+    features = [feature({'type': 'Polygon', 'coordinates': SQUARE}),
+                feature({'type': 'Polygon', 'coordinates': TRIANGLE}, classification='other')]
+    rois = read_geojson_rois(write(tmp_path, features))
+
+    # Full resolution H&E at twice the resized H&E, which is aligned by MLS
+    rng = np.random.default_rng(0)
+    pts_ref = rng.uniform(0, 300, (8, 2))
+    pts_mov = pts_ref * 1.1 + rng.normal(0, 2, (8, 2)) + 5
+    mls = MLSTransform(pts_ref, pts_mov)
+    transform = scale_transform((800, 600), (400, 300)).compose(mls)
+
+    corners, classes = he_script.get_roi_corners(rois, transform, [ColourClass('yellow')])
+
+    for (vertices, _), box in zip(rois, corners):
+        mapped = mls(np.asarray(vertices) / 2)
+        np.testing.assert_allclose(box, [*mapped.min(axis=0)[::-1], *mapped.max(axis=0)[::-1]])
+    np.testing.assert_array_equal(classes, [1, 0])
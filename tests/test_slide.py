@@ -0,0 +1,30 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from slide import Slide
+
+
+def slide_with_points(n_optical, n_he):
+    slide = Slide({})
+    slide.source_points = SimpleNamespace(data=np.arange(2 * n_optical, dtype=float).reshape(-1, 2))
+    slide.target_points = SimpleNamespace(data=np.arange(2 * n_he, dtype=float).reshape(-1, 2))
+    return slide
+
+
+def test_landmarks_are_returned_in_xy():
+    pts_ref, pts_mov = slide_with_points(4, 4).landmarks()
+    np.testing.assert_array_equal(pts_ref, [[1, 0], [3, 2], [5, 4], [7, 6]])
+    np.testing.assert_array_equal(pts_mov, pts_ref)
+
+
+@pytest.mark.parametrize('n_optical, n_he', [(5, 4), (4, 5), (2, 2), (0, 0)])
+def test_unmatched_or_too_few_landmarks_raise(n_optical, n_he):
+    with pytest.raises(ValueError):
+        slide_with_points(n_optical, n_he).landmarks()
+
+
+def test_landmarks_not_placed_raise():
+    with pytest.raises(ValueError):
+        Slide({}).landmarks()
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from transform import AffineTransform, MLSTransform
+
+
+def smooth_deformation(xy):
+    return xy * 1.01 + np.stack([5 * np.sin(xy[:, 1] / 200), 3 * np.cos(xy[:, 0] / 300)], axis=1) + 7
+
+
+@pytest.fixture
+def landmarks():
+    rng = np.random.default_rng(0)
+    p = rng.uniform(0, 1, (64, 2)) * (1200, 600)
+    return p, smooth_deformation(p)
+
+
+def grid_points(step=1):
+    x, y = np.meshgrid(np.arange(0, 600, step, dtype=np.float64), np.arange(0, 300, step, dtype=np.float64))
+    return np.stack([x.ravel(), y.ravel()], axis=1), x.shape
+
+
+def test_affine_fit_inverse_and_compose():
+    rng = np.random.default_rng(1)
+    src = rng.uniform(0, 100, (6, 2))
+    affine = AffineTransform.fit(src, src @ np.array([[2, 0.1], [-0.2, 1.5]]) + (3, -4))
+    np.testing.assert_allclose(affine.rms, 0, atol=1e-9)
+    np.testing.assert_allclose(affine.inverse(affine(src)), src)
+    np.testing.assert_allclose(affine.compose(affine.inverse).matrix, np.eye(3), atol=1e-12)
+
+
+@pytest.mark.parametrize('options', [{'k': 16}, {'radius': 50}, {'radius': 150}, {'k': 8, 'radius': 100}])
+def test_local_mls_is_continuous(landmarks, options):
+    p, q = landmarks
+    points, shape = grid_points()
+    expected_step = MLSTransform(p, q)(points).reshape(shape + (2,))
+    local = MLSTransform(p, q, **options)(points).reshape(shape + (2,))
+
+    def max_step(field):
+        return max(np.abs(np.diff(field, axis=0)).max(), np.abs(np.diff(field, axis=1)).max())
+
+    # One pixel moves the global field by about a pixel, the local one may
+    # only add a little more where neighbours fade in and out
+    assert max_step(local) < max_step(expected_step) + 1
+
+
+def test_local_mls_interpolates_dense_landmarks(landmarks):
+    p, q = landmarks
+    np.testing.assert_allclose(MLSTransform(p, q, k=16)(p), q, atol=1e-6)
+
+
+def test_local_mls_falls_back_to_affine_out_of_range(landmarks):
+    p, q = landmarks
+    far = np.array([[5000.0, 5000.0], [-3000.0, 200.0]])
+    transform = MLSTransform(p, q, radius=50)
+    np.testing.assert_allclose(transform(far), transform.affine(far))
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+import warp
+
+
+@pytest.fixture(params=[(45, 70, 3), (45, 70)], ids=['rgb', 'grey'])
+def levels(request):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, request.param, dtype=np.uint8)
+
+    def shifted(vy, vx):
+        # Integer shift, nearest sampling keeps the pixels exact
+        return np.stack([vx + 3, vy - 2]).astype(np.float32)
+
+    return warp.lazy_warp(image, shifted, order=0, tile_size=16, min_size=8)
+
+
+KEYS = [
+    5, -1, (3, 7), (-2, -5), np.int64(4), (2, slice(None)),
+    slice(3, 30), slice(None, None, 3), (slice(-10, None), slice(2, 60, 7)), slice(None, None, -1),
+    (slice(30, 2, -4), slice(None, None, -3)), slice(40, 60), slice(5, 5),
+    Ellipsis, (Ellipsis, 0), (1, Ellipsis), (slice(4, 9), Ellipsis, slice(2, 5)),
+    np.array([0, 7, 3, 3]), (slice(None), [5, -1, 20]), ([1, 2], [3, 4]), (np.array([[0, 1], [5, 6]]), 2),
+    (np.array([], dtype=np.int64), slice(None)),
+]
+
+
+@pytest.mark.parametrize('key', KEYS, ids=[repr(key) for key in KEYS])
+def test_indexing_matches_numpy(levels, key):
+    for level in levels:
+        expected = np.asarray(level)
+        if isinstance(key, tuple) and len(key) > expected.ndim:
+            key = key[:expected.ndim]
+        try:
+            expected = expected[key]
+        except IndexError:
+            # Out of bounds on the smaller levels
+            with pytest.raises(IndexError):
+                level[key]
+            continue
+        np.testing.assert_array_equal(level[key], expected)
+        assert level[key].shape == expected.shape
+
+
+@pytest.mark.parametrize('key', [None, 1.5, 'a', np.array([True, False]), (0, 0, 0, 0), (100, 0), ([0, -100],)])
+def test_unsupported_or_out_of_bounds_keys_raise_index_error(levels, key):
+    with pytest.raises(IndexError):
+        levels[0][key]